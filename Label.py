@@ -1,9 +1,23 @@
+from array import array
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 from User import User
 
+# Format of the "created" timestamps of the instances
+CREATED_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
 
 class Label(object):
-    def __init__(self, properties):
+    __slots__ = ("id", "_status", "_name", "_data", "user_list", "_versions", "_normalized_versions",
+                 "_ratio", "_freq_list", "_majority", "_group_credits")
+
+    def __init__(self, properties, users=None):
+        """
+        :param properties: the assertion of the input json
+        :param users: dict of user id to User, to share one User per id
+        between the labels. If None, a new User is created for each vote.
+        """
         self.id = properties["id"]
         self._status = properties["status"]
         self._name = properties["name"]
@@ -11,10 +25,14 @@ class Label(object):
         self.user_list = []
 
         self._versions = []  # versions of translations of users
-        self.versions = properties["versions"]
+        self._setVersions(properties["versions"], users)
         self._normalized_versions = {}
         self._ratio = 0.0
         self._freq_list = []
+        # proposition of the majority group, whether consensus is reached or not
+        self._majority = None
+        # group and keys credited with the votes of each proposition
+        self._group_credits = None
 
 
     @property
@@ -42,13 +60,31 @@ class Label(object):
 
     @versions.setter
     def versions(self, v):
+        self._setVersions(v, None)
+
+    def _setVersions(self, v, users):
         self._versions = v
         # get the user information by the way
         for version in self._versions:
             for inst in version["instances"]:
-                u = User(inst["user_id"])
-                u.label_list.append(self)
-                self.user_list.append(u)
+                inst["user_id"] = self.add_user(inst["user_id"], users).id
+
+    def add_user(self, user_id, users=None):
+        """
+        Add a user who voted for the label.
+        :param user_id: id of the user
+        :param users: dict of user id to User shared between the labels, None
+        to create a new User
+        :return: the User
+        """
+        u = users.get(user_id) if users is not None else None
+        if u is None:
+            u = User(user_id)
+            if users is not None:
+                users[user_id] = u
+        u.label_list.append(self)
+        self.user_list.append(u)
+        return u
 
     @property
     def normalized_versions(self):
@@ -66,6 +102,29 @@ class Label(object):
     def ratio(self, v):
         self._ratio = v if v else self._ratio
 
+    @property
+    def majority(self):
+        return self._majority
+
+    @majority.setter
+    def majority(self, v):
+        self._majority = v
+
+    @property
+    def group_credits(self):
+        return self._group_credits
+
+    @group_credits.setter
+    def group_credits(self, v):
+        self._group_credits = v
+
+    @property
+    def groups(self):
+        """
+        The AggMap objects of the groups of propositions.
+        """
+        return self._freq_list
+
     @property
     def freq_list(self):
         return [group.aggMap for group in self._freq_list]
@@ -104,33 +163,86 @@ class Label(object):
     #         version.setdefault()
 
     def votes_sequence(self):
-        seq = []
+        """
+        The normalized propositions of all the votes of the label, in
+        chronological order. The empty propositions are "_emptyKey".
+        """
+        codes, values = self.coded_votes_sequence()
+        return [values[code] for code in codes]
+
+    def coded_votes_sequence(self):
+        """
+        The votes of the label in chronological order, with the propositions
+        encoded as integers so that they can be replayed cheaply.
+        :return: (array of the code of each vote, list of the normalized
+        propositions indexed by code)
+        """
+        codes = {}
+        votes = []
         if self.versions and (self.data is not None) and self.data.get("value"):
             for version in self.versions:
+                value = version["data"]["value"]
+                value = self.normalized_versions[value] if value != "" else "_emptyKey"
+                code = codes.setdefault(value, len(codes))
                 for instance in version["instances"]:
-                    created = instance["created"]
-                    time = datetime.strptime(created, "%Y-%m-%dT%H:%M:%SZ")
-                    if len(seq) < 1:
-                        if version["data"]["value"] == "":
-                            seq.append(("", time))
-                        else:
-                            seq.append((self.normalized_versions[version["data"]["value"]], time))
-                    else:
-                        for i in range(len(seq)):
-                            if time <= seq[i][1]:
-                                if version["data"]["value"] == "":
-                                    seq.insert(i, ("_emptyKey", time))
-                                else:
-                                    seq.insert(i, (self.normalized_versions[version["data"]["value"]], time))
-                                break
-                        if version["data"]["value"] == "":
-                            seq.insert(i, ("_emptyKey", time))
-                        else:
-                            seq.insert(i, (self.normalized_versions[version["data"]["value"]], time))
-                        break
-
-        seq = [s[0] for s in seq]
-        return seq
+                    votes.append((instance["created"], code))
+        return array("i", _chronological(votes)), list(codes)
+
+    def values_sequence(self):
+        """
+        The propositions (not normalized) of all the votes of the label, in
+        chronological order. The empty propositions are "".
+        """
+        votes = []
+        if self.versions:
+            for version in self.versions:
+                value = version["data"].get("value") or ""
+                for instance in version["instances"]:
+                    votes.append((instance["created"], value))
+        return _chronological(votes)
+
+    def chronology_ratio(self, value, final_ratio):
+        """
+        Replay the votes in chronological order to find the first ratio at
+        which the given proposition was the only leader, with more than one
+        vote and a ratio smaller than the final ratio. The counts are kept
+        up to date in O(1) per vote.
+        :param value: the normalized proposition of the consensus
+        :param final_ratio: the ratio of the label with all the votes
+        :return: the ratio, None if it is never found
+        """
+        codes, values = self.coded_votes_sequence()
+        if value not in values:
+            return None
+        target = values.index(value)
+        counts = [0] * len(values)
+        # count of the leaders, and the number of propositions with that count
+        top = 0
+        n_top = 0
+        for n, code in enumerate(codes, start=1):
+            counts[code] += 1
+            if counts[code] > top:
+                top = counts[code]
+                n_top = 1
+            elif counts[code] == top:
+                n_top += 1
+            if code == target and n > 1 and counts[code] == top and n_top == 1:
+                ratio = top / float(n)
+                if ratio < final_ratio:
+                    return ratio
+        return None
+
+    def results(self):
+        """
+        What the consensus computed for the label, to send it back from a
+        worker process without the rest of the label.
+        """
+        return (self._status, self._data, self._normalized_versions, self._ratio, self._freq_list,
+                self._majority, self._group_credits)
+
+    def set_results(self, results):
+        (self._status, self._data, self._normalized_versions, self._ratio, self._freq_list,
+         self._majority, self._group_credits) = results
 
     def to_json(self):
         json = {}
@@ -144,3 +256,35 @@ class Label(object):
                     version["normalized"] = self.normalized_versions[version["data"]["value"]]
         json["versions"] = self.versions
         return json
+
+
+def _chronological(votes):
+    """
+    Sort votes in chronological order.
+    :param votes: list of (created, x)
+    :return: list of the x
+    """
+    # The timestamps in the fixed format sort like the times they
+    # represent, so they only need to be parsed if another format is used
+    if not all(_isFixedFormat(created) for created, _ in votes):
+        votes = [(_parseCreated(created), x) for created, x in votes]
+    votes.sort(key=itemgetter(0))
+    return [x for _, x in votes]
+
+
+def _isFixedFormat(created):
+    """
+    Tell if a timestamp looks like CREATED_FORMAT, e.g. 2016-10-24T08:01:32Z
+    """
+    return len(created) == 20 and created[10] == "T" and created[19] == "Z"
+
+
+@lru_cache(maxsize=1 << 16)
+def _parseCreated(created):
+    """
+    Parse a timestamp in CREATED_FORMAT, or with fractions of seconds.
+    """
+    try:
+        return datetime.strptime(created, CREATED_FORMAT)
+    except ValueError:
+        return datetime.strptime(created, "%Y-%m-%dT%H:%M:%S.%fZ")
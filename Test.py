@@ -1,17 +1,23 @@
-from Label import Label
+from Label import Label, CREATED_FORMAT
 import json
 from math import floor
 import collections
 import os
 import re
 import time
+import contextlib
 import copy
+import itertools
+import multiprocessing
+import types
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
-import difflib as df
 import string
-from User import User
+from util import SparseLabels
+import similarity
+import profiling
+from raykar_no_feature import DawidSkeneClassifier
 
 
 class AggMap:
@@ -22,6 +28,8 @@ class AggMap:
         used to group words that a similar. Only words who are in the majority
         AggMap will be considered as a solution to the consensus.
     """
+    __slots__ = ("total", "aggMap")
+
     def __init__(self):
         self.total = 0
         self.aggMap = collections.defaultdict(int)
@@ -31,13 +39,288 @@ class AggMap:
         return str(self.total) + str(self.aggMap)
 
 
+class ResultWriter(object):
+    """
+        Writes the results of the consensus in an output folder as the pages
+        come. result.json is written as an incremental json array of pages,
+        and ConsensusCount.txt gets one line per page. Both files are buffered
+        and the pages are never kept in memory.
+        The files are written under a temporary name and renamed by close, so
+        that a run failing midway does not leave a truncated result which
+        looks complete.
+    """
+    def __init__(self, outputFolder, buffering=1 << 20):
+        self.paths = [os.path.join(outputFolder, 'result.json'), os.path.join(outputFolder, 'ConsensusCount.txt')]
+        self.result = open(self.paths[0] + '.tmp', 'w', buffering=buffering)
+        self.consensusCount = open(self.paths[1] + '.tmp', 'w', buffering=buffering)
+        self.result.write('{"subjects": [')
+        self.pages = 0
+
+    def write_page(self, page, consensus_count):
+        """
+        :param page: json of the page, with the json of the labels as assertions
+        :param consensus_count: number of labels of the page reaching consensus
+        """
+        if self.pages > 0:
+            self.result.write(', ')
+        # json.dumps uses the C encoder, json.dump does not
+        self.result.write(json.dumps(page))
+        self.consensusCount.write(str(consensus_count) + " / " + str(len(page["assertions"])) + "\n")
+        self.pages += 1
+
+    def close(self):
+        """
+        End the json array and give the files their final names.
+        """
+        self.result.write(']}')
+        self.result.close()
+        self.consensusCount.close()
+        for path in self.paths:
+            os.replace(path + '.tmp', path)
+
+    def abort(self):
+        """
+        Remove the files written so far, the previous results are kept.
+        """
+        self.result.close()
+        self.consensusCount.close()
+        for path in self.paths:
+            os.remove(path + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class NormalizationCache(object):
+    """
+        Bounded LRU cache of normalized strings. The same names and places
+        come back in many labels, so each string is normalized only once.
+        The keys include the normalizer chain, so that changing the cleaners
+        or the translation tables does not return stale results.
+        hits and misses count the lookups.
+    """
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: the value cached for key, or None
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return "NormalizationCache(size=%d, maxsize=%d, hits=%d, misses=%d)" % (
+            len(self.entries), self.maxsize, self.hits, self.misses)
+
+
+class CompiledTranslation(dict):
+    """
+        A translation table compiled in a map of each word to its translation,
+        so that a string is translated with one lookup per word. It gives the
+        same result as looking up each word in the table:
+        - a word is looked up in lower case,
+        - a word ending with '.' is looked up without it and the '.' is dropped
+          when it is translated,
+        - a word ending with ',', ';', ')' or ']' is looked up without it and
+          the punctuation is kept.
+        The whitespaces are collapsed in single spaces.
+        The translations of the words are computed the first time they are
+        seen; at most maxsize words are kept.
+    """
+    def __init__(self, table, maxsize=1 << 16):
+        super(CompiledTranslation, self).__init__()
+        self.table = table
+        self.maxsize = maxsize
+
+    def __missing__(self, word):
+        table = self.table
+        last = word[-1]
+        if last == '.':
+            translated = table.get(word[:-1].lower(), word)
+        elif last in ',;)]':
+            translated = table.get(word[:-1].lower(), word[:-1]) + last
+        else:
+            translated = table.get(word.lower(), word)
+        if len(self) >= self.maxsize:
+            self.clear()
+        self[word] = translated
+        return translated
+
+    def translate(self, s):
+        return ' '.join(map(self.__getitem__, s.split()))
+
+    def translate_many(self, strings):
+        """
+        :param strings: list of strings
+        :return: list of the translated strings
+        """
+        get = self.__getitem__
+        return [' '.join(map(get, s.split())) for s in strings]
+
+
+# Translation table removing the punctuation, for normalize_string
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+# Whitespace between the json tokens
+_JSON_WHITESPACE = re.compile(r'\s*')
+
+
+class _JsonReader(object):
+    """
+        Reads the json values of a file one at a time. The file is read by
+        chunks and each value is decoded as soon as it is complete in the
+        buffer.
+    """
+    def __init__(self, js, chunk_size):
+        self.js = js
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+
+    def _readMore(self, size):
+        """
+        Add size characters of the file to the buffer.
+        :return: False at the end of the file
+        """
+        more = self.js.read(size)
+        if not more:
+            return False
+        self.buf = self.buf[self.pos:] + more
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        :return: the next character which is not whitespace, '' at the end of
+        the file
+        """
+        while True:
+            self.pos = _JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._readMore(self.chunk_size):
+                return ""
+
+    def expect(self, c):
+        """
+        Skip the next character, which must be c.
+        """
+        if self.peek() != c:
+            raise ValueError("Expected " + repr(c) + " in " + self.js.name)
+        self.pos += 1
+
+    def decode(self):
+        """
+        :return: the next json value
+        """
+        self.peek()
+        # The read size is doubled each time so that a value bigger than a
+        # chunk is not decoded too often
+        read_size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number may go on in the next chunk
+                if end < len(self.buf) or not self._readMore(read_size):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if not self._readMore(read_size):
+                    raise
+            read_size *= 2
+
+
+def iter_subjects(inputFile, chunk_size=1 << 16):
+    """
+    Iterates over the pages of the "subjects" array of a json file one at a
+    time, so that the whole file is never loaded in memory.
+    The file is read by chunks and each page is decoded as soon as it is
+    complete in the buffer. The values of the other keys of the top level
+    object are decoded and skipped.
+    :param inputFile: json file in the format {"subjects": [page, page, ...]}
+    :param chunk_size: number of characters read from the file at a time
+    :return: generator of the pages (dicts)
+    """
+    with open(inputFile) as js:
+        reader = _JsonReader(js, chunk_size)
+        # Find the "subjects" key of the top level object
+        reader.expect("{")
+        while True:
+            if reader.peek() == "}":
+                raise ValueError('No "subjects" array found in ' + inputFile)
+            key = reader.decode()
+            reader.expect(":")
+            if key == "subjects":
+                break
+            reader.decode()
+            if reader.peek() == ",":
+                reader.expect(",")
+
+        reader.expect("[")
+        if reader.peek() == "]":
+            return
+        while True:
+            yield reader.decode()
+            c = reader.peek()
+            if c == "]":
+                return
+            if c == "":
+                raise ValueError('Unterminated "subjects" array in ' + inputFile)
+            reader.expect(",")
+
+
 class MajorityVoting(object):
-    def __init__(self, inputFile, mv=1):
+    def __init__(self, inputFile, mv=1, stream=False, profiler=None, lazy=False):
+        """
+        :param inputFile: json file of the pages
+        :param mv: minimum number of votes of a label
+        :param stream: read the pages one at a time from the input file
+        instead of loading them, see iter_labels_by_page
+        :param profiler: profiling.Profiler measuring the stages
+        :param lazy: do not load the pages yet, load has to be called
+        """
         # Indicates if output is verbose for debugging
         self.debug = False
+        # Timers and counters of the stages, see profiling.Profiler
+        self.profiler = profiler if profiler is not None else profiling.NullProfiler()
 
         # Input json file
-        self.input_json = self.read_inputJson(inputFile)
+        self.inputFile = inputFile
+        # Indicates if the pages are read one at a time from the input file
+        # instead of loading the whole json in memory. In this mode the pages
+        # are not kept after their consensus is calculated.
+        self.stream = stream
+        # Input json and Label objects of the pages, see load
+        self.input_json = None
 
         # Output json; initialize by copy the input
         self.output_pages = []
@@ -46,7 +329,9 @@ class MajorityVoting(object):
         # Minimum workers required
         self.min_votes = mv
         self.list_ratio = []
-        self.workers = []
+        # One shared User per user id (not kept in streaming mode, since the
+        # users keep their labels)
+        self.workers = {}
         self.total_labels = 0
         # Label that consensus entries are grouped by
         # self.keyLabel = self.getKeyLabel()
@@ -60,16 +345,23 @@ class MajorityVoting(object):
         #                                (top group > second top group) "True"
         self.top2 = False
 
-        # Maps the labels to the translation tables and dictionaries they will
-        # need
+        # Maps the labels (Label objects or label ids) to the translation
+        # tables and dictionaries they will need
         self.labelMap = None
         # Labels to find a consensus for
         # self.labels = labelMap.keys()
-        self.labels_by_page = self.get_labels_by_page()
-        self.copy_labels = copy.deepcopy(self.labels_by_page)
+        # Original status of each label, in the order of the labels, for
+        # compare_results; filled by get_labels_by_page
+        self.original_status = bytearray()
+        self.labels_by_page = None
+        # Index of the labels by id, built when needed by add_vote
+        self._labelsById = None
         # The current translation table
         self.translationTable = None
+        # Translation table of each label, keyed by the Label or by its id
         self.translationTables = None
+        # The translation tables compiled by _compiledTranslation, by id
+        self._compiledTranslations = {}
         # The current spell correction dictionary
         self.correctionDictionary = None
 
@@ -81,12 +373,35 @@ class MajorityVoting(object):
         # Exact String comparator - originally does only exact match
         # Can be decorated for more functionality
         self.comparator = self._exactMatch
-        # Approximate string comparator
-        self.approx = self._exactMatch
+        # Approximate string comparator: the similarity backend of the lossy
+        # comparisons, see set_similarity
+        self.approx = similarity.DifflibSimilarity()
         # ratio of similarity of 2 strings
         self.lossy_ratio = 0.9
         # Flag to ignore empty strings
         self.ignoreEmptyStrings = False
+        # Consensus of the labels given by a crowd model instead of the
+        # majority, see use_model: label id -> (proposition, probability)
+        self.model_consensus = None
+        # Strings already normalized, shared by all the labels
+        self.normalization_cache = NormalizationCache()
+
+        if not stream and not lazy:
+            self.load()
+
+    def load(self):
+        """
+        Reads the input file and initiates the Label objects of the pages.
+        Called by the constructor, unless lazy or stream is given.
+        """
+        if self.stream:
+            raise ValueError("The pages are read as they are needed in streaming mode")
+        with self.profiler.timer("load"):
+            self.input_json = self.read_inputJson(self.inputFile)
+        self.workers = {}
+        self.original_status = bytearray()
+        self._labelsById = None
+        self.labels_by_page = self.get_labels_by_page()
 
     def setOutputFolder(self, outputFolder):
         """
@@ -124,30 +439,39 @@ class MajorityVoting(object):
         """
         normalized = string
         # Call the other cleaning functions before
-        if self.translationTables.get(label):
-            parts = string.split()
-            for i in range(len(parts)):
-                if parts[i]:
-                    if parts[i][-1] == '.':
-                        translated = self.translationTables.get(label).get(parts[i][:-1].lower(), parts[i])
-                    elif parts[i][-1] in [',', ';', ')', ']']:
-                        translated = self.translationTables.get(label).get(parts[i][:-1].lower(), parts[i][:-1]) + \
-                                     parts[i][-1]
-                    else:
-                        translated = self.translationTables.get(label).get(parts[i].lower(), parts[i])
-                    if parts[i] != translated:
-                        parts[i] = translated
-            normalized = ' '.join(parts)
+        table = self._translationTable(label)
+        if table:
+            normalized = self._compiledTranslation(table).translate(string)
         return normalized
 
+    def _translationTable(self, label):
+        """
+        :return: the translation table of a label, None if there is none or
+        if the translation normalizer is not used
+        """
+        if not self.useTranslationNormalizer:
+            return None
+        return _byLabel(self.translationTables, label)
+
+    def _compiledTranslation(self, table):
+        """
+        The translation table compiled once. A table changed after being
+        compiled must be removed from self._compiledTranslations.
+        :param table: dict of lower case word to its translation
+        :return: CompiledTranslation
+        """
+        compiled = self._compiledTranslations.get(id(table))
+        if compiled is None or compiled.table is not table:
+            compiled = self._compiledTranslations[id(table)] = CompiledTranslation(table)
+        return compiled
+
     def normalize_string(self, s):
         """
         remove punctuation
         :param s: string to normalize
         :return: string normalized
         """
-        trans = str.maketrans('', '', string.punctuation)
-        s = s.translate(trans)
+        s = s.translate(_PUNCTUATION_TABLE)
 
         # to lowercase
         s = s.lower()
@@ -176,19 +500,42 @@ class MajorityVoting(object):
         """
         count = 0
         labels_by_page = []
-        for subject in self.input_json["subjects"]:
-            sb = {"id": subject["id"], "superID": subject["superID"], "assertions": []}
-            if subject["assertions"] is not None and len(subject["assertions"]) > 0:
-                for assertion in subject["assertions"]:
-                    if assertion is not None:
-                        if assertion["versions"] and len(assertion["versions"]) > 1:
-                            l = Label(assertion)
-                            count += 1
-                            sb["assertions"].append(l)
-                labels_by_page.append(sb)
+        with self.profiler.timer("labels"):
+            for subject in self.input_json["subjects"]:
+                sb = self._pageFromSubject(subject)
+                if sb is not None:
+                    count += len(sb["assertions"])
+                    labels_by_page.append(sb)
+                    self.original_status.extend(_originalStatus(label) for label in sb["assertions"])
         print(count)
         return labels_by_page
 
+    def _pageFromSubject(self, subject):
+        """
+        Initiate the Label objects of one page.
+        :param subject: a page of the input json
+        :return: the page with Label objects, None if the page has no assertion.
+        """
+        if subject["assertions"] is None or len(subject["assertions"]) == 0:
+            return None
+        sb = {"id": subject["id"], "superID": subject["superID"], "assertions": []}
+        for assertion in subject["assertions"]:
+            if assertion is not None:
+                if assertion["versions"] and len(assertion["versions"]) > 1:
+                    sb["assertions"].append(Label(assertion, None if self.stream else self.workers))
+        return sb
+
+    def iter_labels_by_page(self):
+        """
+        Iterate over the pages with their Label objects. In streaming mode the
+        pages are read from the input file as they are needed.
+        :return: iterator of pages
+        """
+        if self.labels_by_page is not None:
+            return iter(self.labels_by_page)
+        return (sb for sb in map(self._pageFromSubject, iter_subjects(self.inputFile))
+                if sb is not None)
+
     def _getSortedAttrsForLabel(self, label):
         """
         Get lossless normalization.
@@ -201,16 +548,7 @@ class MajorityVoting(object):
             for version in label.versions:
                 # original emigrant json has more than one items, which maybe not exist in our case
                 if version["data"].get("value"):
-                    normalized = self.clean(version["data"]["value"])
-                    # Apply all lossless functions for this attribute
-                    if self.useFunctionNormalizer and False:  # - TODO
-                        losslessFuncs = self.labelMap[label].funcs
-                        for func in losslessFuncs:
-                            normalized = getattr(self, func)(normalized)
-
-                    # Apply all lossless translation tables for this attribute
-                    if self.useTranslationNormalizer:
-                        normalized = self.translateString(label, normalized)
+                    normalized = self._normalize(label, version["data"]["value"])
                     # if attr[key] != normalized and (self.useFunctionNormalizer or self.useTranslationNormalizer):
                     # if version["data"] != normalized or (self.useFunctionNormalizer or self.useTranslationNormalizer):
                     #     self.normalizedFileWriter.writerow(["orig:", version["data"]["value"]])
@@ -234,6 +572,70 @@ class MajorityVoting(object):
 
         return sortedAttrsCopy
 
+    def _normalize(self, label, value):
+        """
+        Lossless normalization of a proposition of a label.
+        :param label: the label of the proposition
+        :param value: the proposition
+        :return: the normalized proposition
+        """
+        table = self._translationTable(label)
+        if self.clean == self._noChange and not table:
+            return value
+        key = (self.clean, id(table) if table else None, value)
+        normalized = self.normalization_cache.get(key)
+        if normalized is None:
+            normalized = self._normalizeUncached(label, value)
+            self.normalization_cache.put(key, normalized)
+        return normalized
+
+    def normalizePage(self, page):
+        """
+        Lossless normalization of all the propositions of the labels of a
+        page, in label.normalized_versions. The propositions to translate
+        with the same table are translated together.
+        :param page: the page
+        """
+        # Propositions to translate, by table, then by cache key
+        pending = collections.defaultdict(dict)
+        for label in page["assertions"]:
+            table = self._translationTable(label)
+            normalized_versions = {}
+            for version in label.versions:
+                value = version["data"].get("value")
+                if not value or value in normalized_versions:
+                    continue
+                if not table:
+                    normalized_versions[value] = self._normalize(label, value)
+                    continue
+                key = (self.clean, id(table), value)
+                normalized = self.normalization_cache.get(key)
+                if normalized is None:
+                    pending[id(table)].setdefault(key, (table, []))[1].append(label)
+                normalized_versions[value] = normalized
+            label.normalized_versions = normalized_versions
+
+        for entries in pending.values():
+            table = next(iter(entries.values()))[0]
+            translated = self._compiledTranslation(table).translate_many(
+                [self.clean(value) for _, _, value in entries])
+            for (key, (_, labels)), normalized in zip(entries.items(), translated):
+                self.normalization_cache.put(key, normalized)
+                for label in labels:
+                    label.normalized_versions[key[2]] = normalized
+
+    def _normalizeUncached(self, label, value):
+        normalized = self.clean(value)
+        # Apply all lossless functions for this attribute
+        if self.useFunctionNormalizer and False:  # - TODO
+            losslessFuncs = _byLabel(self.labelMap, label).funcs
+            for func in losslessFuncs:
+                normalized = getattr(self, func)(normalized)
+
+        # Apply all lossless translation tables for this attribute
+        if self.useTranslationNormalizer:
+            normalized = self.translateString(label, normalized)
+        return normalized
 
     def _buildFrequencyList(self, label, useLossyNormalizers):
         """
@@ -250,53 +652,109 @@ class MajorityVoting(object):
         :param useLossyNormalizers: whether to use lossy normalization
         :return: the frequence list of each proposition
         """
+        # Votes of each proposition. Joining a group counts the votes of the
+        # first version with that value, creating a group counts all of them.
+        firstVotes = {}
+        allVotes = collections.defaultdict(int)
+        for version in label.versions:
+            value = version["data"].get("value")
+            if value:
+                firstVotes.setdefault(value, version["votes"])
+                allVotes[value] += version["votes"]
+        # Lossy normalization of each string, computed only once
+        lossyCache = {}
+
         freqList = []
+        # Group and keys credited with the votes of each proposition, to add
+        # votes later without grouping again
+        credits = {}
         # Loop over each attribute to try to put it in a group
         for original, normalized in label.normalized_versions.items():
-            attrFound = False
-            # Look over all groups 第一次循环没有freqlist为空，所以直接添加第一个attr
-            for group in freqList:
-                for key in group.aggMap.keys():
-                    # Insert exactly
-                    if self.comparator(key, normalized):  # key == normalized
-                        for version in label.versions:
-                            if version["data"].get("value"):
-                                if version["data"]["value"] == original:
-                                    group.aggMap[key] += version["votes"]
-                                    group.total += version["votes"]
-                                    attrFound = True
-                                    break
-                        break
-                    # Try approximate match needed
-                    if useLossyNormalizers:
-                        s1 = self.lossyClean(key)
-                        s2 = self.lossyClean(normalized)
-                        seq = df.SequenceMatcher(None, s1, s2)
-                        # if seq.ratio() >= 0.9:  # similarity between 2 string to see if they are similar
-                        # if s1 == s2:  # if self.approx(s1, s2) or self.comparator(s1, s2):
-                        if seq.ratio() >= self.lossy_ratio:
-                            for version in label.versions:
-                                if version["data"].get("value"):
-                                    if version["data"]["value"] == original:
-                                        group.aggMap[normalized] += version["votes"]
-                                        group.aggMap[key] += version["votes"]
-                                        group.total += version["votes"]
-                                        attrFound = True
-                                        break
-                            break
-                if attrFound:
-                    break
-            # If no exact or approximate matches, create a new entry
-            if not attrFound:
-                newEntry = AggMap()
-                for version in label.versions:
-                    if version["data"].get("value"):
-                        if version["data"]["value"] == original:
-                            newEntry.aggMap[normalized] += version["votes"]
-                            newEntry.total += version["votes"]
-                freqList.append(newEntry)
+            credits[original] = self._addToFrequencyList(freqList, normalized, firstVotes[original],
+                                                         allVotes[original], useLossyNormalizers, lossyCache)
+        label.group_credits = credits
         return freqList
 
+    def _addToFrequencyList(self, freqList, normalized, firstVotes, allVotes, useLossyNormalizers, lossyCache):
+        """
+        Put a proposition in the group of the first key matching it, or in a
+        new group if no key matches.
+        :param freqList: the frequence list
+        :param normalized: the normalized proposition
+        :param firstVotes: votes added when joining a group
+        :param allVotes: votes added when creating a group
+        :param useLossyNormalizers: whether to use lossy normalization
+        :param lossyCache: dict of the strings already normalized
+        :return: (group, keys of the group credited with the votes)
+        """
+        exactMatch = self.comparator == self._exactMatch
+        candidate = None
+        # Look over all groups 第一次循环没有freqlist为空，所以直接添加第一个attr
+        for group in freqList:
+            for key in group.aggMap.keys():
+                # Insert exactly
+                if key == normalized if exactMatch else self.comparator(key, normalized):
+                    group.aggMap[key] += firstVotes
+                    group.total += firstVotes
+                    return group, (key,)
+                # Try approximate match needed
+                if useLossyNormalizers:
+                    if candidate is None:
+                        candidate = self._lossyCandidate(normalized, lossyCache)
+                    if self._lossyMatch(candidate, key, lossyCache):
+                        group.aggMap[normalized] += firstVotes
+                        group.aggMap[key] += firstVotes
+                        group.total += firstVotes
+                        return group, (normalized, key)
+        # If no exact or approximate matches, create a new entry
+        newEntry = AggMap()
+        newEntry.aggMap[normalized] += allVotes
+        newEntry.total += allVotes
+        freqList.append(newEntry)
+        return newEntry, (normalized,)
+
+    def _lossyCleaned(self, s, lossyCache):
+        """
+        Lossy normalization of a string, prepared for the similarity backend.
+        :param s: the string
+        :param lossyCache: dict of the strings already normalized for the
+        label, looked up before self.normalization_cache
+        :return: the string cleaned and prepared by self.approx
+        """
+        cleaned = lossyCache.get(s)
+        if cleaned is None:
+            key = (self.lossyClean, self.approx, s)
+            cleaned = self.normalization_cache.get(key)
+            if cleaned is None:
+                cleaned = self.approx.prepare(self.lossyClean(s))
+                self.normalization_cache.put(key, cleaned)
+            lossyCache[s] = cleaned
+        return cleaned
+
+    def _lossyCandidate(self, normalized, lossyCache):
+        """
+        Prepare a string to be compared with the keys of the groups.
+        :return: matcher of self.approx for the string
+        """
+        return self.approx.matcher(self._lossyCleaned(normalized, lossyCache), self.lossy_ratio)
+
+    def _lossyMatch(self, candidate, key, lossyCache):
+        """
+        Tell if the similarity of a key and a candidate proposition reaches
+        self.lossy_ratio, with the backend self.approx. With the difflib
+        backend, the same as
+        df.SequenceMatcher(None, lossyClean(key), lossyClean(normalized)).ratio() >= self.lossy_ratio
+        """
+        return candidate(self._lossyCleaned(key, lossyCache))
+
+    def set_similarity(self, backend, **kwargs):
+        """
+        Sets the similarity backend of the lossy comparisons.
+        :param backend: a similarity.SimilarityBackend or the name of one:
+        "difflib", "levenshtein" or "qgram"
+        :param kwargs: arguments of the backend, when it is given by name
+        """
+        self.approx = similarity.get_backend(backend, **kwargs)
 
     def _majorityFromFrequencyList(self, freqList):
         """
@@ -345,6 +803,28 @@ class MajorityVoting(object):
                 majorGroupKey.append(key)
         return majorEntry, maxVotes_entry, maxVotes_group, majorGroupKey
 
+    def _consensusRatio(self, maxVotes_entry, maxVotes_group, totalVotes, min_votes=None):
+        """
+        Ratio of the votes of the majority group of a label.
+        :param min_votes: minimum number of votes, self.min_votes by default
+        :return: the ratio, 0 if the label has less than min_votes votes
+        """
+        min_votes = self.min_votes if min_votes is None else min_votes
+        ratio = 0
+        if totalVotes >= min_votes:  # - TODO original: 1 // self.minVotes
+            # It only makes sense to calsulate ratio if there is more
+            # than 1 worker's answer
+            if self.top2:
+                if (maxVotes_group != -1):
+                    ratio = maxVotes_entry / float(maxVotes_entry + maxVotes_group)
+                else:
+                    ratio = 1
+            else:
+                ratio = maxVotes_entry / float(totalVotes)
+        else:
+            ratio = 0
+        return ratio
+
     def getConsensus(self, page):
         """
         For each label in the page, get their consensus.
@@ -353,6 +833,9 @@ class MajorityVoting(object):
         """
         consensus_count = 0
         labels_count = 0
+        profiler = self.profiler
+        with profiler.timer("normalization"):
+            self.normalizePage(page)
         # Iterate over the labels to to find a consensus per label
         for label in page["assertions"]:
 
@@ -361,9 +844,8 @@ class MajorityVoting(object):
             # Indicates if consensus is reached for a particular label
             consensusFound = False
 
-            # Get the sorted attributes for this label from the original
-            # attribute set
-            sortedAttrsCopy = self._getSortedAttrsForLabel(label)
+            # The attributes of the label were normalized with the page
+            profiler.histogram("labels_by_propositions", len(label.normalized_versions))
 
             # Two iterations to find consensus: the first without the lossy
             # normalizers and the second with the lossy normalizers. All labels
@@ -385,28 +867,26 @@ class MajorityVoting(object):
                 # words will be located in the same group.
                 # group.total = cumulative weight of this group
                 # group.aggMap = dictionary of key to weight
-                freqList = self._buildFrequencyList(label, useLossyNormalizers)
+                with profiler.timer("grouping"):
+                    freqList = self._buildFrequencyList(label, useLossyNormalizers)
                 label.freq_list = freqList
                 # Get the majority entry(ies), the votes for that entry(ies),
                 # as well the entries that voted for the majority entry(ies).
                 # if label.id == '580dba0d61643900032cbb03':
                 #     print()
-                majorEntry, maxVotes_entry, maxVotes_group, majorGroupKey = self._majorityFromFrequencyList(freqList)
+                with profiler.timer("majority"):
+                    majorEntry, maxVotes_entry, maxVotes_group, majorGroupKey = \
+                        self._majorityFromFrequencyList(freqList)
+                label.majority = majorEntry[0] if len(majorEntry) > 0 else None
                 totalVotes = label.totalvotes()
-
-                ratio = 0
-                if totalVotes >= self.min_votes:  # - TODO original: 1 // self.minVotes
-                    # It only makes sense to calsulate ratio if there is more
-                    # than 1 worker's answer
-                    if self.top2:
-                        if (maxVotes_group != -1):
-                            ratio = maxVotes_entry / float(maxVotes_entry + maxVotes_group)
-                        else:
-                            ratio = 1
-                    else:
-                        ratio = maxVotes_entry / float(totalVotes)
-                else:
-                    ratio = 0
+                ratio = self._consensusRatio(maxVotes_entry, maxVotes_group, totalVotes)
+                if self.model_consensus is not None and label.id in self.model_consensus:
+                    # The proposition of the model, with its probability as
+                    # ratio if the label has enough votes
+                    proposition, probability = self.model_consensus[label.id]
+                    majorEntry = [proposition]
+                    label.majority = proposition
+                    ratio = probability if totalVotes >= self.min_votes else 0
 
                 if label.data is not None:
                     if label.data.get("value"):  # for test when seuil = 0
@@ -431,17 +911,20 @@ class MajorityVoting(object):
         self.total_labels += labels_count
         return consensus_count, labels_count
 
-    def calculateConsensus(self):
+    def calculateConsensus(self, n_jobs=1):
         """
         Reads the input file, computes the grouping and majority, and writes the
         results to the output files.
         Should be called after setting any optional parameters for the
         ConsensusCalculator.
+        :param n_jobs: number of processes computing the consensus of the pages
+        in parallel. The results do not depend on it.
         :return the percentage of consensus found
         """
 
         if not self.outputFolder:
-            self.outputFolder = os.path.dirname(self.inputJson)
+            # The folder of the input file ('' for a file name without folder)
+            self.outputFolder = os.path.dirname(os.path.abspath(self.inputFile))
         if not os.path.exists(self.outputFolder):
             os.makedirs(self.outputFolder)
 
@@ -451,34 +934,263 @@ class MajorityVoting(object):
         # Create and write consensus data
         # Data written to output is not sorted by keyLabel
         numPagesProcessed = 0
-        total_page = len(self.labels_by_page)
+        total_page = len(self.labels_by_page) if self.labels_by_page is not None else "?"
         total_consensus = 0
         total_label = 0
-        # ...
-        outputJson = []
         startTime = time.time()
-        with open(os.path.join(self.outputFolder, 'ConsensusCount.txt'), 'w') as output:
-            for page in self.labels_by_page:  # for key in sorted(output_json["subjects"]):  #
-                consensus_count, labels_count = self.getConsensus(page)
+        # The pages are written to the output as soon as their consensus is found
+        with ResultWriter(self.outputFolder) as output:
+            for page, consensus_count, labels_count in self._iterConsensus(n_jobs):
                 total_consensus += consensus_count
                 total_label += labels_count
-                temp = copy.deepcopy(page)
-                temp["assertions"] = [label.to_json() for label in page["assertions"]]
-                outputJson.append(temp)
+                with self.profiler.timer("output"):
+                    output.write_page(self._pageJson(page, [label.to_json() for label in page["assertions"]]),
+                                      consensus_count)
                 numPagesProcessed += 1
                 # Print some output for calculations that take a long time
                 if numPagesProcessed % 1000 == 0:
                     print("Completed", numPagesProcessed, "out of", total_page, "pages")
-                output.write(str(consensus_count) + " / " + str(len(page["assertions"])) + "\n")
-                output.flush()
         stopTime = time.time()
         print("Total times:", stopTime - startTime)
-        print("output to json...")
-        file_to_write = open(os.path.join(self.outputFolder, 'result.json'), 'w')
-        json.dump({"subjects": outputJson}, file_to_write)
-        file_to_write.close()
+        if self.profiler.enabled:
+            self.profiler.count("pages", numPagesProcessed)
+            with open(os.path.join(self.outputFolder, 'profile.json'), 'w') as f:
+                json.dump(self.profile_report(), f, indent=2)
         return total_consensus * 1.0 / total_label
 
+    def profile_report(self):
+        """
+        Report of self.profiler, with the counters of the similarity backend
+        and of the normalization cache.
+        :return: json serializable dict
+        """
+        self._observeCounters()
+        return self.profiler.report()
+
+    def _observeCounters(self):
+        """
+        Add to the counters of the profiler the comparisons done by the
+        similarity backend and the lookups of the normalization cache.
+        """
+        self.profiler.observe("similarity_calls", self.approx.calls)
+        self.profiler.observe("normalization_cache_hits", self.normalization_cache.hits)
+        self.profiler.observe("normalization_cache_misses", self.normalization_cache.misses)
+
+    def _pageJson(self, page, assertions):
+        """
+        Json of a page for the output, with the given json of its labels.
+        """
+        return {"id": page["id"], "superID": page["superID"], "assertions": assertions}
+
+    def sweep_seuil(self, seuils, output_prefix=None, n_jobs=1):
+        """
+        Computes the percentage of consensus for several seuils in one run.
+        The ratio of a label does not depend on the seuil, so the ratios are
+        computed once, sorted, and the number of labels reaching each seuil is
+        found by binary search.
+        The labels keep their ratio (and self.list_ratio is filled) but their
+        status and data are not changed, since there is no single seuil.
+        :param seuils: list of seuils
+        :param output_prefix: if given, the result of each seuil s is written
+        as calculateConsensus does in the folder output_prefix + str(s)
+        :param n_jobs: number of processes computing the consensus of the pages
+        :return: list of the percentages of consensus, one per seuil
+        """
+        seuils = list(seuils)
+        outputFolders = []
+        if output_prefix is not None:
+            outputFolders = [output_prefix + str(s) for s in seuils]
+            for folder in outputFolders:
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+
+        # No label reaches an infinite seuil, so none of them is changed
+        seuil = self.seuil
+        self.seuil = float("inf")
+        try:
+            with contextlib.ExitStack() as stack:
+                outputs = [stack.enter_context(ResultWriter(folder)) for folder in outputFolders]
+                list_ratio_start = len(self.list_ratio)
+                for page, _, _ in self._iterConsensus(n_jobs):
+                    for s, output in zip(seuils, outputs):
+                        assertions = [self._labelJsonAtSeuil(label, s) for label in page["assertions"]]
+                        consensus_count = sum(1 for label in page["assertions"] if self._reachesSeuil(label, s))
+                        output.write_page(self._pageJson(page, assertions), consensus_count)
+            ratios = np.sort(self.list_ratio[list_ratio_start:])
+        finally:
+            self.seuil = seuil
+
+        # Number of labels with ratio >= s
+        reached = len(ratios) - np.searchsorted(ratios, seuils, side="left")
+        return [float(r) / len(ratios) for r in reached]
+
+    def _labelJsonAtSeuil(self, label, seuil):
+        """
+        Json of a label as getConsensus would leave it with the given seuil,
+        without changing the label.
+        """
+        json_label = label.to_json()
+        if self._reachesSeuil(label, seuil):
+            json_label["status"] = "completed"
+            json_label["data"] = dict(label.data, value=label.majority) if label.majority else {}
+        return json_label
+
+    def _reachesSeuil(self, label, seuil):
+        """
+        Tell if getConsensus would find the consensus of a label with the given seuil.
+        """
+        return label.ratio >= seuil and label.data is not None and bool(label.data.get("value"))
+
+    def add_vote(self, label_id, user_id, value, created=None):
+        """
+        Add the vote of a worker to a label and update the consensus of this
+        label in place, without computing the other labels again.
+        The groups of propositions do not depend on the votes, so a vote for a
+        known proposition only adds to the count of its group, and a new
+        proposition is grouped as the last one of the label would be.
+        Like in getConsensus, a label which reached consensus stays completed.
+        :param label_id: id of the label
+        :param user_id: id of the worker
+        :param value: the proposition of the worker, not normalized
+        :param created: timestamp of the vote, now by default
+        :return: the label if its consensus changed (completed or another
+        proposition chosen), else None
+        """
+        label = self._labelById(label_id)
+        if created is None:
+            created = time.strftime(CREATED_FORMAT, time.gmtime())
+
+        version = None
+        for v in label.versions:
+            if (v["data"].get("value") or "") == value:
+                version = v
+                break
+        if version is None:
+            version = {"data": {"value": value}, "votes": 0, "instances": []}
+            label.versions.append(version)
+        version["votes"] += 1
+        version["instances"].append({"user_id": user_id, "created": created})
+        label.add_user(user_id, None if self.stream else self.workers)
+
+        if label.group_credits is None:
+            self._groupLabel(label)
+        elif value:
+            credit = label.group_credits.get(value)
+            if credit is None:
+                normalized = self._normalize(label, value)
+                label.normalized_versions[value] = normalized
+                label.group_credits[value] = self._addToFrequencyList(label.groups, normalized, 1, 1, True, {})
+            else:
+                group, keys = credit
+                for key in keys:
+                    group.aggMap[key] += 1
+                group.total += 1
+
+        majorEntry, maxVotes_entry, maxVotes_group, _ = self._majorityFromFrequencyList(label.groups)
+        label.majority = majorEntry[0] if len(majorEntry) > 0 else None
+        label.ratio = self._consensusRatio(maxVotes_entry, maxVotes_group, label.totalvotes())
+        if self._reachesSeuil(label, self.seuil):
+            changed = label.status != "completed" or label.data.get("value") != label.majority
+            label.status = "completed"
+            label.data = label.majority
+            if changed:
+                return label
+        return None
+
+    def add_votes(self, votes):
+        """
+        Add several votes with add_vote.
+        :param votes: iterable of (label_id, user_id, value) or
+        (label_id, user_id, value, created)
+        :return: list of the labels whose consensus changed, in the order
+        of their last change
+        """
+        changed = collections.OrderedDict()
+        for vote in votes:
+            label = self.add_vote(*vote)
+            if label is not None:
+                changed.pop(label.id, None)
+                changed[label.id] = label
+        return list(changed.values())
+
+    def _labelById(self, label_id):
+        """
+        Find a label by its id, with an index built at the first call.
+        """
+        if self._labelsById is None:
+            if self.labels_by_page is None:
+                raise ValueError("The labels are not kept in memory in streaming mode")
+            self._labelsById = {label.id: label for page in self.labels_by_page for label in page["assertions"]}
+        return self._labelsById[label_id]
+
+    def _iterConsensus(self, n_jobs):
+        """
+        Computes the consensus of each page, in the order of the pages.
+        With n_jobs > 1, the pages are sent by chunks to a pool of processes.
+        The consensus of a page does not depend on the other pages, so only the
+        ratios and the count of labels computed by the workers have to be
+        merged back, and the results of each label are set on the label.
+        :param n_jobs: number of processes
+        :return: generator of (page, consensus_count, labels_count)
+        """
+        pages = self.iter_labels_by_page()
+        if n_jobs <= 1:
+            for page in pages:
+                consensus_count, labels_count = self.getConsensus(page)
+                yield page, consensus_count, labels_count
+            return
+
+        with multiprocessing.Pool(n_jobs, initializer=_init_consensus_worker,
+                                  initargs=(self._workerCopy(),)) as pool:
+            # Only a few chunks are sent in advance, so that in streaming mode
+            # the pages are not all read in memory
+            pending = collections.deque()
+            chunks = iter(lambda: list(itertools.islice(pages, _CONSENSUS_CHUNK)), [])
+            for chunk in itertools.chain(chunks, [None]):
+                if chunk is not None:
+                    pending.append((chunk, pool.apply_async(_pages_consensus, (chunk,))))
+                while pending and (chunk is None or len(pending) > 2 * n_jobs):
+                    done, result = pending.popleft()
+                    pages_results, profile = result.get()
+                    self.profiler.merge(profile)
+                    for page, (results, consensus_count, labels_count, ratios) in zip(done, pages_results):
+                        # Only the results of the labels come back from the workers
+                        for label, label_results in zip(page["assertions"], results):
+                            label.set_results(label_results)
+                        self.list_ratio.extend(ratios)
+                        self.total_labels += labels_count
+                        yield page, consensus_count, labels_count
+
+    def _workerCopy(self):
+        """
+        Copy of the settings of this object, without the pages, to be sent to
+        the worker processes.
+        """
+        worker = copy.copy(self)
+        worker.input_json = None
+        worker.labels_by_page = None
+        worker.original_status = bytearray()
+        worker._labelsById = None
+        worker.workers = {}
+        # The pages are pickled to the workers, so their labels are other
+        # objects there: the settings of the labels are found by label id
+        worker.labelMap = _byLabelId(self.labelMap)
+        worker.translationTables = _byLabelId(self.translationTables)
+        worker.normalization_cache = NormalizationCache(self.normalization_cache.maxsize)
+        # The measures of the workers are sent back with their results; the
+        # counters already reached in this process are not counted again
+        worker.profiler = type(self.profiler)()
+        worker._observeCounters()
+        worker.profiler.drain()
+        worker.list_ratio = []
+        worker.total_labels = 0
+        # Bind again the cleaners and comparators to the copy, otherwise they
+        # would send this whole object with them
+        for name, value in vars(worker).items():
+            if getattr(value, "__self__", None) is self:
+                setattr(worker, name, types.MethodType(value.__func__, worker))
+        return worker
+
     def chronology(self):
         def auto_label(rects, ax, xticks):
             # Get y-axis height to calculate label position from.
@@ -498,43 +1210,10 @@ class MajorityVoting(object):
         list_ratio = []
         for page in self.labels_by_page:
             for label in page["assertions"]:
-                versions = {}
-                seq = label.votes_sequence()
-                found = False
-                for t in seq:
-                    # build the proposition dict
-                    if versions.get(t):
-                        versions[t] += 1
-                    else:
-                        versions.setdefault(t, 1)
-
-                    if t == label.data["value"]:  # test if it is valide consensus
-                        # sort by counts
-                        lst = sorted(versions.items(), key=lambda x: x[1], reverse=True)
-                        values = versions.values()
-                        vl = 0
-                        for v in values:
-                            vl += v
-                        if lst[0][0] == label.data["value"]:  # if it is majority
-                            ratio = lst[0][1] / float(vl)
-                            if vl > 1:
-                                if len(lst) > 1:
-                                    # if the second majority pass that ratio, not valide
-                                    if lst[1][1] / float(vl) >= ratio:
-                                        continue
-                                    else:
-                                        # if ratio is smaller, yes!
-                                        if ratio < label.ratio:
-                                            list_ratio.append(ratio)  # consensus found
-                                            found = True
-                                            break
-                                if ratio < label.ratio:
-                                    list_ratio.append(ratio)
-                                    found = True
-                                    break
-                # if cant not find the valide consensus, just make the same ratio
-                if not found and (label.data is not None) and label.data.get("value"):
-                    list_ratio.append(label.ratio)
+                if (label.data is not None) and label.data.get("value"):
+                    ratio = label.chronology_ratio(label.data["value"], label.ratio)
+                    # if cant not find the valide consensus, just make the same ratio
+                    list_ratio.append(label.ratio if ratio is None else ratio)
 
         def compare_chronology(l1, l2):
             '''
@@ -634,6 +1313,84 @@ class MajorityVoting(object):
             plt.show()
         compare_chronology(self.list_ratio, list_ratio)
 
+    def votes_needed(self, seuil=None, min_votes=None):
+        """
+        For each label, replay its votes in chronological order to find how
+        many votes were needed to reach consensus with the given seuil, to
+        know how many workers a task needs.
+        :param seuil: the seuil of consensus, self.seuil by default
+        :param min_votes: minimal number of votes, self.min_votes by default
+        :return: (dict of label id to the number of votes needed, None if the
+        consensus is never reached; dict of aggregate statistics)
+        """
+        seuil = self.seuil if seuil is None else seuil
+        min_votes = self.min_votes if min_votes is None else min_votes
+        per_label = {}
+        agree = 0
+        for page in self.labels_by_page:
+            for label in page["assertions"]:
+                if (label.data is not None) and label.data.get("value"):
+                    n, value = self._votesToConsensus(label, seuil, min_votes)
+                    per_label[label.id] = n
+                    if n is not None and value == label.majority:
+                        agree += 1
+
+        needed = np.array([n for n in per_label.values() if n is not None])
+        stats = {
+            "seuil": seuil,
+            "min_votes": min_votes,
+            "labels": len(per_label),
+            "reached": len(needed),
+            # the proposition reached first is the majority with all the votes
+            "agree_with_majority": agree,
+            "mean": float(needed.mean()) if len(needed) else None,
+            "median": float(np.median(needed)) if len(needed) else None,
+            "histogram": {int(n): int(c) for n, c in zip(*np.unique(needed, return_counts=True))},
+        }
+        return per_label, stats
+
+    def _votesToConsensus(self, label, seuil, min_votes):
+        """
+        Replay the votes of a label in chronological order to find how many
+        votes were needed before getConsensus would have found its consensus
+        with the given seuil, i.e. when the collect of votes could have
+        stopped. Each vote is counted in the group of its proposition, as
+        add_vote does, and the empty votes only count in the total.
+        :param label: the label
+        :param seuil: the seuil of consensus
+        :param min_votes: minimal number of votes before stopping
+        :return: (number of votes, normalized proposition of the majority),
+        (None, None) if the consensus is never reached
+        """
+        if label.group_credits is None:
+            self._groupLabel(label)
+        # The groups of the label with only the votes replayed so far, in the
+        # order of the groups so that the ties are broken the same way
+        replay = [AggMap() for _ in label.groups]
+        index = {id(group): i for i, group in enumerate(label.groups)}
+        for n, value in enumerate(label.values_sequence(), start=1):
+            if value:
+                group, keys = label.group_credits[value]
+                replayGroup = replay[index[id(group)]]
+                for key in keys:
+                    replayGroup.aggMap[key] += 1
+                replayGroup.total += 1
+            majorEntry, maxVotes_entry, maxVotes_group, _ = self._majorityFromFrequencyList(replay)
+            # No group has a vote yet
+            if not majorEntry:
+                continue
+            if self._consensusRatio(maxVotes_entry, maxVotes_group, n, min_votes) >= seuil:
+                return n, majorEntry[0]
+        return None, None
+
+    def _groupLabel(self, label):
+        """
+        Normalize and group the propositions of a label which was never
+        grouped.
+        """
+        self._getSortedAttrsForLabel(label)
+        label.freq_list = self._buildFrequencyList(label, True)
+
     def plot_seuil(self):
         '''
         polot each consensus ratio
@@ -866,49 +1623,160 @@ class MajorityVoting(object):
         plt.show()
 
     def get_workers_contributions(self):
-        label_list = []
-        majority_list = np.zeros
-        worker_list = []
-        workers_labels = []
-        count = 0
+        """
+        Build the matrix of the contributions of the workers to the labels
+        which have a value. The propositions are encoded as integers per
+        label, so the matrix can be given to RaykarClassifier (for labels with
+        2 propositions) or to any model taking SparseLabels.
+        If a worker gave several propositions for the same label, each of
+        them is an entry of the matrix.
+        :return: (SparseLabels of shape (n_workers, n_labels) with the code of
+        the proposition of each worker for each label,
+        list of the user ids of the rows,
+        list of the label ids of the columns,
+        list of the normalized propositions of each label, indexed by code)
+        """
+        worker_index = {}
+        worker_ids = []
+        label_ids = []
+        propositions = []
+        workers = []
+        labels = []
+        codes = []
         for page in self.labels_by_page:
-            labels = page["assertions"]
-            if len(labels) > 0:
-                for label in labels:
-                    if label.versions and (label.data is not None) and label.data.get("value"):
-                        label_list.append(label.id)
-                        for version in label.versions:
-                            for instance in version["instances"]:
-                                match = [x for x in worker_list if x.id == instance["user_id"]]
-                                if len(match) > 0:  # user_id exists
-                                    i = worker_list.index(match[0])
-                                    if version["data"]["value"] != '':
-                                        workers_labels[i][count] = label.normalized_versions[version["data"]["value"]]
-                                else:  #user_id not found
-                                    workers_labels.append(np.zeros(self.total_labels, dtype=str))
-                                    if version["data"]["value"] != '':
-                                        workers_labels[-1][count] = label.normalized_versions[version["data"]["value"]]
-                                        user = User(instance['user_id'])
-                                        worker_list.append(user)
-
-                        count += 1
-        return np.array(workers_labels), np.array(worker_list), np.array(label_list)
+            for label in page["assertions"]:
+                if label.versions and (label.data is not None) and label.data.get("value"):
+                    if not label.normalized_versions:
+                        self._getSortedAttrsForLabel(label)
+                    column = len(label_ids)
+                    label_ids.append(label.id)
+                    code_index = {}
+                    for version in label.versions:
+                        value = version["data"]["value"]
+                        if value == '':
+                            continue
+                        normalized = label.normalized_versions[value]
+                        code = code_index.setdefault(normalized, len(code_index))
+                        for instance in version["instances"]:
+                            row = worker_index.get(instance["user_id"])
+                            if row is None:
+                                row = worker_index[instance["user_id"]] = len(worker_ids)
+                                worker_ids.append(instance["user_id"])
+                            workers.append(row)
+                            labels.append(column)
+                            codes.append(code)
+                    propositions.append(list(code_index))
+        matrix = SparseLabels(workers, labels, codes, shape=(len(worker_ids), len(label_ids)))
+        return matrix, worker_ids, label_ids, propositions
+
+    def use_model(self, model=None):
+        """
+        Fit a crowd model on the contributions of the workers, and use it
+        instead of the majority of the groups to find the consensus: the
+        proposition of a label is the most probable one under the model, and
+        its ratio is its probability. Should be called before
+        calculateConsensus; not available in streaming mode.
+        :param model: model with fit(matrix, n_candidates) and
+        predict_proba(), a DawidSkeneClassifier by default
+        :return: the fitted model
+        """
+        if self.labels_by_page is None:
+            raise ValueError("use_model needs all the labels, it is not available in streaming mode")
+        if model is None:
+            model = DawidSkeneClassifier()
+        matrix, worker_ids, label_ids, propositions = self.get_workers_contributions()
+        model.fit(matrix, [len(p) for p in propositions])
+        self.model_consensus = {}
+        for label_id, label_propositions, posterior in zip(label_ids, propositions, model.predict_proba()):
+            if label_propositions:
+                best = int(posterior.argmax())
+                self.model_consensus[label_id] = (label_propositions[best], float(posterior[best]))
+        return model
 
     def compare_results(self):
+        """
+        Compare the labels that were complete in the input with the labels
+        completed by the consensus.
+        :return: (count of labels complete in the input, count of labels completed)
+        """
         count1 = 0
         count2 = 0
-        for i in range(len(self.copy_labels)):
-            labels = self.copy_labels[i]["assertions"]
-            for j in range(len(labels)):
-                if labels[j].data is not None:
-                    if labels[j].data.get("value"):
-                        if labels[j].status == "complete":
-                            count1 += 1
-                        if self.labels_by_page[i]["assertions"][j].status == "completed":
-                            count2 += 1
+        labels = (label for page in self.labels_by_page for label in page["assertions"])
+        for status, label in zip(self.original_status, labels):
+            if status != _STATUS_NO_VALUE:
+                if status == _STATUS_COMPLETE:
+                    count1 += 1
+                if label.status == "completed":
+                    count2 += 1
         return count1, count2
 
 
+# Original status of a label: without value in "data", not complete, complete
+_STATUS_NO_VALUE = 0
+_STATUS_NOT_COMPLETE = 1
+_STATUS_COMPLETE = 2
+
+
+def _originalStatus(label):
+    """
+    Compact snapshot of the original status of a label, for compare_results.
+    """
+    if label.data is None or not label.data.get("value"):
+        return _STATUS_NO_VALUE
+    return _STATUS_COMPLETE if label.status == "complete" else _STATUS_NOT_COMPLETE
+
+
+def _byLabel(settings, label):
+    """
+    :param settings: dict of the settings of the labels (labelMap,
+    translationTables), keyed by the Label or by its id, or None
+    :return: the setting of the label, None if it has none
+    """
+    if not settings:
+        return None
+    setting = settings.get(label)
+    if setting is None:
+        setting = settings.get(label.id)
+    return setting
+
+
+def _byLabelId(settings):
+    """
+    :return: the settings of the labels keyed by label id
+    """
+    if settings is None:
+        return None
+    return {getattr(label, "id", label): setting for label, setting in settings.items()}
+
+
+# Number of pages sent at a time to a worker process
+_CONSENSUS_CHUNK = 64
+# The MajorityVoting object of a worker process
+_consensus_worker = {}
+
+
+def _init_consensus_worker(majorityVoting):
+    _consensus_worker["mv"] = majorityVoting
+
+
+def _pages_consensus(pages):
+    """
+    Computes the consensus of some pages in a worker process.
+    :param pages: list of pages
+    :return: (list of (results of the labels, consensus_count, labels_count,
+    list of ratios), one per page, measures of the profiler)
+    """
+    majorityVoting = _consensus_worker["mv"]
+    results = []
+    for page in pages:
+        majorityVoting.list_ratio = []
+        consensus_count, labels_count = majorityVoting.getConsensus(page)
+        results.append(([label.results() for label in page["assertions"]], consensus_count, labels_count,
+                        majorityVoting.list_ratio))
+    majorityVoting._observeCounters()
+    return results, majorityVoting.profiler.drain()
+
+
 def plot(ax, axes_x, axes_y, color="blue"):
     x = np.array(axes_x)
     y = np.array(axes_y)
@@ -919,16 +1787,11 @@ def plot(ax, axes_x, axes_y, color="blue"):
 
 
 def find_seuil1(start, end, scan):
-    percentage_consensus = []
-    seuil = []
-    for s in np.arange(start, end, scan):
-        getConsensus = MajorityVoting('dataset.json', 3)
-        getConsensus.setOutputFolder('resTotal_' + str(s))
-        getConsensus.set_seuil(s)
-        pc = getConsensus.calculateConsensus()
-        percentage_consensus.append(pc)
-        seuil.append(s)
-    plot(seuil, percentage_consensus)
+    seuil = list(np.arange(start, end, scan))
+    getConsensus = MajorityVoting('dataset.json', 3)
+    percentage_consensus = getConsensus.sweep_seuil(seuil, output_prefix='resTotal_')
+    fig, ax = plt.subplots()
+    plot(ax, seuil, percentage_consensus)
 
 
 def combine_json(dit):
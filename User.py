@@ -1,6 +1,8 @@
 
 
 class User(object):
+    __slots__ = ("_id", "_confidence", "label_list")
+
     def __init__(self, id, confidence=0):
         self._id = id
         self._confidence = confidence
@@ -17,3 +19,12 @@ class User(object):
     @confidence.setter
     def confidence(self, v):
         self._confidence = v if v is not None else 0
+
+    def __getstate__(self):
+        # The labels of the user are not sent with it, otherwise pickling a
+        # label would pickle all the labels of all its users
+        return self._id, self._confidence
+
+    def __setstate__(self, state):
+        self._id, self._confidence = state
+        self.label_list = []
@@ -0,0 +1,318 @@
+"""
+Benchmark of the consensus pipeline on synthetic datasets.
+
+A dataset in the format of the emigrant json (subjects / assertions /
+versions) is generated with a given size, then each stage of the pipeline
+is timed separately: load of the json, construction of the Label objects,
+normalization, grouping, majority and serialization of the results. The
+times, the throughput and the peak memory are appended as one json line to
+a results file, so that the runs can be compared.
+
+    python benchmark.py --pages 2000 --labels 5 --propositions 4 --votes 7
+
+With --check-parallel N_JOBS, the consensus computed with N_JOBS processes
+and translation tables is compared with the serial one instead, and with
+--check-model the Dawid-Skene model is checked on sparse workers.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+import numpy
+
+from Test import MajorityVoting, ResultWriter
+from profiling import Profiler
+from raykar_no_feature import DawidSkeneClassifier
+from util import SparseLabels
+
+_SYLLABLES = ["an", "ber", "ca", "do", "el", "fa", "gre", "hin", "is", "jo", "ka", "lu", "mar", "ne", "ol",
+              "pe", "qui", "ro", "sa", "ti", "u", "ver", "wal", "xe", "ya", "zo"]
+_PREFIXES = ["", "", "", "Mr. ", "Mrs. ", "St. ", "Dr. "]
+_TYPO_CHARACTERS = "abcdefghijklmnopqrstuvwxyz .,"
+
+
+def _random_name(rng):
+    words = []
+    for _ in range(rng.randint(1, 3)):
+        word = "".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 3)))
+        words.append(word.capitalize())
+    return rng.choice(_PREFIXES) + " ".join(words)
+
+
+def _typo(rng, s):
+    """
+    :return: s with 1 to 3 characters replaced, deleted or inserted
+    """
+    s = list(s)
+    for _ in range(rng.randint(1, 3)):
+        i = rng.randrange(len(s) + 1)
+        op = rng.random()
+        if op < 1 / 3.0 and i < len(s):
+            s[i] = rng.choice(_TYPO_CHARACTERS)
+        elif op < 2 / 3.0 and i < len(s) and len(s) > 1:
+            del s[i]
+        else:
+            s.insert(i, rng.choice(_TYPO_CHARACTERS))
+    return "".join(s)
+
+
+def generate_dataset(n_pages=1000, labels_per_page=5, propositions=4, typo_rate=0.5, votes=7, n_users=200,
+                     seed=0):
+    """
+    Generate a synthetic dataset in the format of the input json.
+    :param n_pages: number of pages
+    :param labels_per_page: number of labels of each page
+    :param propositions: number of different values proposed for each label
+    :param typo_rate: probability that a proposition other than the true
+    value is a typo of it, else it is another random name
+    :param votes: number of votes of each label; half of them are for the
+    true value
+    :param n_users: number of different users
+    :param seed: seed of the random generator
+    :return: dict {"subjects": [...]}
+    """
+    rng = random.Random(seed)
+    start = datetime.datetime(2016, 1, 1)
+    subjects = []
+    for p in range(n_pages):
+        assertions = []
+        for a in range(labels_per_page):
+            truth = _random_name(rng)
+            values = [truth]
+            for _ in range(propositions - 1):
+                values.append(_typo(rng, truth) if rng.random() < typo_rate else _random_name(rng))
+            instances = {}
+            for _ in range(votes):
+                value = truth if rng.random() < 0.5 else rng.choice(values)
+                created = start + datetime.timedelta(seconds=rng.randrange(365 * 24 * 3600))
+                instances.setdefault(value, []).append({"user_id": "u%d" % rng.randrange(n_users),
+                                                        "created": created.strftime("%Y-%m-%dT%H:%M:%S.000Z")})
+            versions = [{"data": {"value": value}, "votes": len(inst), "instances": inst}
+                        for value, inst in instances.items()]
+            assertions.append({"id": "l%d_%d" % (p, a), "status": rng.choice(["complete", "active"]),
+                               "name": "name", "data": {"value": truth}, "versions": versions})
+        subjects.append({"id": "p%d" % p, "superID": "s%d.json" % (p % 10), "assertions": assertions})
+    return {"subjects": subjects}
+
+
+def peak_rss_mb():
+    """
+    :return: the peak resident memory of the process in MB, None if unknown
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def run_benchmark(inputFile, seuil=0.5, min_votes=1, outputFolder=None):
+    """
+    Run the pipeline on a dataset and time each stage.
+    :param inputFile: json file of the dataset
+    :param seuil: seuil of the consensus
+    :param min_votes: minimum number of votes of a label
+    :param outputFolder: folder of the results, a temporary one by default
+    :return: dict with the time of each stage in seconds, the number of
+    pages and labels, the throughput in labels per second and the peak RSS
+    """
+    times = dict.fromkeys(["load", "labels", "normalization", "grouping", "majority", "serialization"], 0.0)
+    temporary = outputFolder is None
+    if temporary:
+        outputFolder = tempfile.mkdtemp()
+    try:
+        # The load of the json and the construction of the Label objects are
+        # timed by the profiler inside load
+        profiler = Profiler()
+        majorityVoting = MajorityVoting(inputFile, min_votes, profiler=profiler, lazy=True)
+        majorityVoting.set_seuil(seuil)
+        majorityVoting.load()
+        times["load"] = profiler.stages["load"][0]
+        times["labels"] = profiler.stages["labels"][0]
+
+        # The normalization and the grouping are timed by the profiler inside
+        # getConsensus, the rest of it is the majority
+        start = time.perf_counter()
+        counts = [majorityVoting.getConsensus(page) for page in majorityVoting.labels_by_page]
+        times["normalization"] = profiler.stages["normalization"][0]
+        times["grouping"] = profiler.stages["grouping"][0]
+        times["majority"] = time.perf_counter() - start - times["normalization"] - times["grouping"]
+
+        start = time.perf_counter()
+        with ResultWriter(outputFolder) as output:
+            for page, (consensus_count, _) in zip(majorityVoting.labels_by_page, counts):
+                output.write_page(majorityVoting._pageJson(page, [label.to_json() for label in page["assertions"]]),
+                                  consensus_count)
+        times["serialization"] = time.perf_counter() - start
+    finally:
+        if temporary:
+            shutil.rmtree(outputFolder)
+
+    total = sum(times.values())
+    labels = sum(len(page["assertions"]) for page in majorityVoting.labels_by_page)
+    return {"stages": times, "total": total, "pages": len(majorityVoting.labels_by_page), "labels": labels,
+            "labels_per_second": labels / total if total else None,
+            "consensus": sum(c for c, _ in counts) * 1.0 / max(sum(n for _, n in counts), 1),
+            "peak_rss_mb": peak_rss_mb(), "profile": majorityVoting.profile_report()}
+
+
+def _translation_tables(majorityVoting):
+    """
+    A translation table for every label, translating the words of its
+    propositions to upper case, keyed by Label.
+    """
+    tables = {}
+    for page in majorityVoting.iter_labels_by_page():
+        for label in page["assertions"]:
+            words = (word for version in label.versions for word in (version["data"].get("value") or "").split())
+            tables[label] = {word.lower(): word.upper() for word in words}
+    return tables
+
+
+def check_parallel(inputFile, n_jobs=2, seuil=0.5, min_votes=1, translation=True):
+    """
+    Check that the consensus computed with n_jobs processes is the same as
+    the serial one: same percentage of consensus, and same result.json and
+    ConsensusCount.txt.
+    :param inputFile: json file of the dataset
+    :param n_jobs: number of processes of the parallel run
+    :param seuil: seuil of the consensus
+    :param min_votes: minimum number of votes of a label
+    :param translation: use a translation table on every label
+    :return: list of the differences, empty if the results are the same
+    """
+    results = []
+    folders = []
+    try:
+        for jobs in (1, n_jobs):
+            majorityVoting = MajorityVoting(inputFile, min_votes)
+            majorityVoting.set_seuil(seuil)
+            if translation:
+                majorityVoting.translationTables = _translation_tables(majorityVoting)
+                majorityVoting.useTranslationNormalizer = True
+            folders.append(tempfile.mkdtemp())
+            majorityVoting.setOutputFolder(folders[-1])
+            results.append(majorityVoting.calculateConsensus(n_jobs=jobs))
+        differences = []
+        if results[0] != results[1]:
+            differences.append("consensus {} != {}".format(*results))
+        for name in ("result.json", "ConsensusCount.txt"):
+            contents = []
+            for folder in folders:
+                with open(os.path.join(folder, name)) as f:
+                    contents.append(f.read())
+            if contents[0] != contents[1]:
+                differences.append(name + " differs")
+        return differences
+    finally:
+        for folder in folders:
+            shutil.rmtree(folder)
+
+
+def check_model_sparse(n_items=1000, votes=3, seuil=0.6):
+    """
+    Check that the Dawid-Skene model stays confident on unanimous labels
+    when each worker gives only one vote, as in the real data where most
+    workers label a few items.
+    :param n_items: number of labels, each with 2 propositions
+    :param votes: number of votes of each label, all for the first
+    proposition and each from another worker
+    :param seuil: probability the first proposition of each label must reach
+    :return: list of the differences, empty if all the labels reach seuil
+    """
+    n_votes = n_items * votes
+    labels = SparseLabels(numpy.arange(n_votes), numpy.repeat(numpy.arange(n_items), votes),
+                          numpy.zeros(n_votes), shape=(n_votes, n_items))
+    model = DawidSkeneClassifier().fit(labels, numpy.full(n_items, 2))
+    probabilities = numpy.array([posterior[0] for posterior in model.predict_proba()])
+    below = int((probabilities < seuil).sum())
+    if below:
+        return ["{} unanimous labels out of {} below {} (min {:.3f})".format(below, n_items, seuil,
+                                                                        probabilities.min())]
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the consensus pipeline")
+    parser.add_argument("--input", help="json file to benchmark, instead of a generated dataset")
+    parser.add_argument("--pages", type=int, default=1000, help="number of pages of the generated dataset")
+    parser.add_argument("--labels", type=int, default=5, help="number of labels per page")
+    parser.add_argument("--propositions", type=int, default=4, help="number of propositions per label")
+    parser.add_argument("--typo-rate", type=float, default=0.5, help="probability that a proposition is a typo")
+    parser.add_argument("--votes", type=int, default=7, help="number of votes per label")
+    parser.add_argument("--users", type=int, default=200, help="number of users")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated dataset")
+    parser.add_argument("--seuil", type=float, default=0.5, help="seuil of the consensus")
+    parser.add_argument("--min-votes", type=int, default=1, help="minimum number of votes of a label")
+    parser.add_argument("--keep-dataset", help="where to save the generated dataset")
+    parser.add_argument("--results", default="benchmark_results.jsonl", help="file the results are appended to")
+    parser.add_argument("--name", default="", help="name of the run in the results file")
+    parser.add_argument("--check-parallel", type=int, metavar="N_JOBS",
+                        help="instead of the benchmark, check that the consensus with N_JOBS processes and a "
+                             "translation table on every label is the same as the serial one")
+    parser.add_argument("--check-model", action="store_true",
+                        help="instead of the benchmark, check that the Dawid-Skene model is confident on unanimous "
+                             "labels of workers with one vote each")
+    args = parser.parse_args()
+
+    if args.check_model:
+        differences = check_model_sparse()
+        for difference in differences:
+            print(difference)
+        print("model not confident on sparse workers" if differences else "model confident on sparse workers")
+        sys.exit(1 if differences else 0)
+
+    parameters = {"seuil": args.seuil, "min_votes": args.min_votes}
+    inputFile = args.input
+    if inputFile is None:
+        parameters.update(pages=args.pages, labels=args.labels, propositions=args.propositions,
+                          typo_rate=args.typo_rate, votes=args.votes, users=args.users, seed=args.seed)
+        dataset = generate_dataset(args.pages, args.labels, args.propositions, args.typo_rate, args.votes,
+                                   args.users, args.seed)
+        inputFile = args.keep_dataset or tempfile.mkstemp(suffix=".json")[1]
+        with open(inputFile, "w") as f:
+            json.dump(dataset, f)
+        del dataset
+    else:
+        parameters["input"] = inputFile
+
+    try:
+        if args.check_parallel is not None:
+            differences = check_parallel(inputFile, args.check_parallel, args.seuil, args.min_votes)
+        else:
+            result = run_benchmark(inputFile, args.seuil, args.min_votes)
+    finally:
+        if args.input is None and args.keep_dataset is None:
+            os.remove(inputFile)
+
+    if args.check_parallel is not None:
+        for difference in differences:
+            print(difference)
+        print("parallel run differs from the serial one" if differences else "parallel run same as the serial one")
+        sys.exit(1 if differences else 0)
+
+    result.update(name=args.name, date=datetime.datetime.now().isoformat(), parameters=parameters)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    for stage, seconds in result["stages"].items():
+        print("{:<15}{:8.3f}s".format(stage, seconds))
+    print("{:<15}{:8.3f}s".format("total", result["total"]))
+    print("{} labels, {:.0f} labels/s, peak RSS {:.1f} MB".format(result["labels"], result["labels_per_second"],
+                                                               result["peak_rss_mb"]))
+
+
+if __name__ == "__main__":
+    main()
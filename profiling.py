@@ -0,0 +1,152 @@
+"""
+Timers and counters of the stages of the consensus.
+
+MajorityVoting calls its profiler around each stage. The default one,
+NullProfiler, does nothing, so that the hooks cost almost nothing when the
+profiling is disabled. Profiler measures the time and the number of calls of
+each stage, and counts events, and its report can be written as json.
+"""
+
+import collections
+import json
+import time
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullProfiler(object):
+    """
+        Profiler which measures nothing.
+    """
+    enabled = False
+
+    def timer(self, stage):
+        """
+        :param stage: name of the stage
+        :return: context manager measuring the time of the stage
+        """
+        return _NULL_TIMER
+
+    def count(self, name, n=1):
+        """
+        Add n to the counter name.
+        """
+
+    def histogram(self, name, key, n=1):
+        """
+        Add n to the bin key of the histogram name.
+        """
+
+    def observe(self, name, total):
+        """
+        Add to the counter name what a running total (for example the hits of
+        a cache) increased since the last time it was observed.
+        """
+
+    def drain(self):
+        """
+        :return: what was measured since the last drain, to be merged in
+        another profiler (from a worker process), None if nothing
+        """
+        return None
+
+    def merge(self, data):
+        """
+        Add the measures returned by the drain of another profiler.
+        """
+
+    def report(self):
+        return {}
+
+
+class _Timer(object):
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stage[0] += time.perf_counter() - self.start
+        self.stage[1] += 1
+        return False
+
+
+def _newStage():
+    return [0.0, 0]
+
+
+class Profiler(NullProfiler):
+    """
+        Measures the time and the number of calls of each stage, and counts
+        events. The counters are collections.Counter, the histograms are
+        collections.Counter by bin.
+    """
+    enabled = True
+
+    def __init__(self):
+        # stage -> [seconds, calls]
+        self.stages = collections.defaultdict(_newStage)
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(collections.Counter)
+        self._observed = {}
+
+    def timer(self, stage):
+        return _Timer(self.stages[stage])
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def histogram(self, name, key, n=1):
+        self.histograms[name][key] += n
+
+    def observe(self, name, total):
+        self.counters[name] += total - self._observed.get(name, 0)
+        self._observed[name] = total
+
+    def drain(self):
+        data = (dict(self.stages), dict(self.counters), {name: dict(h) for name, h in self.histograms.items()})
+        self.stages.clear()
+        self.counters.clear()
+        self.histograms.clear()
+        return data
+
+    def merge(self, data):
+        if data is None:
+            return
+        stages, counters, histograms = data
+        for stage, (seconds, calls) in stages.items():
+            self.stages[stage][0] += seconds
+            self.stages[stage][1] += calls
+        self.counters.update(counters)
+        for name, h in histograms.items():
+            self.histograms[name].update(h)
+
+    def report(self):
+        """
+        :return: json serializable dict of the stages (seconds and calls), the
+        counters and the histograms
+        """
+        return {
+            "stages": {stage: {"seconds": seconds, "calls": calls}
+                       for stage, (seconds, calls) in self.stages.items()},
+            "counters": dict(self.counters),
+            # the keys of json objects are strings
+            "histograms": {name: {str(k): v for k, v in sorted(h.items())} for name, h in self.histograms.items()},
+        }
+
+    def write_report(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
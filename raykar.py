@@ -6,15 +6,25 @@ The Australian National University
 """
 
 import logging
+import multiprocessing
+import os
 import time
+import warnings
 
 import numpy
 import scipy.optimize
+import scipy.special
+import sklearn.exceptions
 import sklearn.linear_model
+import sklearn.utils
 
-from util import majority_vote, logistic_regression
+from util import majority_vote, logistic_regression, as_sparse_labels, \
+    SparseLabels
 
 EPS = 1E-8
+# scipy.optimize.minimize methods that use the Hessian.
+HESSIAN_OPTIMISERS = {'newton-cg', 'dogleg', 'trust-ncg', 'trust-krylov',
+                      'trust-exact'}
 
 
 class RaykarClassifier(object):
@@ -23,43 +33,139 @@ class RaykarClassifier(object):
     Jointly learns an annotator model and a classification model.
     """
 
-    def __init__(self, n_restarts=5, epsilon=1e-5, lr_init=True):
+    def __init__(self, n_restarts=5, epsilon=1e-5, lr_init=True,
+                 optimiser='BFGS', n_jobs=1, random_state=None,
+                 max_iter=500, ll_tol=None, callback=None, warm_start=False):
         """
         n_restarts: Number of times to run the algorithm. Higher numbers improve
             chances of finding a global maximum likelihood solution.
-        epsilon: Convergence threshold.
+        epsilon: Convergence threshold on the root mean square change of μ,
+            which doesn't grow with the number of samples.
         lr_init: Whether to initialise w using logistic regression.
+        optimiser: scipy.optimize.minimize method used for the w step, e.g.
+            'BFGS', 'L-BFGS-B', 'Newton-CG' or 'trust-ncg'. The analytic
+            gradient is always used, and the Hessian for the methods that
+            accept one.
+        n_jobs: Number of processes running the restarts in parallel. -1 uses
+            all the CPUs.
+        random_state: Seed of the restarts. Each restart gets its own seed
+            drawn from it, so the result doesn't depend on n_jobs. None uses
+            the global random state.
+        max_iter: Maximum number of EM iterations of each restart. A
+            ConvergenceWarning is raised if it is reached.
+        ll_tol: Also stop when the log-likelihood per sample changes by less
+            than ll_tol between two iterations. None to only use epsilon.
+        callback: Function called after each iteration with the record of
+            the iteration (see history_); returning True stops the restart.
+            Only called when the restarts run in this process (n_jobs=1).
+        warm_start: Whether fit starts from the parameters of the previous
+            fit (one run, no restarts) instead of the majority vote. New
+            labellers start with α = β = 0.5, which tells nothing.
+
+        After fit, history_ is the list of the iterations of the best
+        restart, each a dict with the iteration number, its time in seconds,
+        the change of μ (delta) and the log-likelihood.
         """
         self.n_restarts = n_restarts
         self.epsilon = epsilon
         self.lr_init = lr_init
+        self.optimiser = optimiser
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.max_iter = max_iter
+        self.ll_tol = ll_tol
+        self.callback = callback
+        self.warm_start = warm_start
 
     def fit(self, X, Y):
         """
         X: (n_samples, n_features) NumPy array of data.
-        Y: (n_labellers, n_samples) NumPy masked array of crowd labels.
+        Y: (n_labellers, n_samples) NumPy masked array of crowd labels, or
+            SparseLabels (or anything accepted by util.as_sparse_labels).
         """
+        Y = as_sparse_labels(Y)
         if X.shape[0] != Y.shape[1]:
             raise ValueError('X and Y have different numbers of samples.')
 
-        results = []
-        for trial in range(self.n_restarts):
-            logging.debug('Trial {}/{}'.format(trial + 1, self.n_restarts))
-            a, b, w = self._fit_params(X, Y)
-            self.a_, self.b_, self.w_ = a, b, w
-            lh = self.score(X, Y)
-            results.append((lh, (a, b, w)))
+        seeds = sklearn.utils.check_random_state(self.random_state).randint(
+                numpy.iinfo(numpy.int32).max, size=self.n_restarts)
+
+        n_jobs = self.n_jobs if self.n_jobs > 0 else os.cpu_count()
+        n_jobs = min(n_jobs, self.n_restarts)
+        if self.warm_start and getattr(self, 'w_', None) is not None:
+            if self.w_.shape[0] != X.shape[1] + 1:
+                raise ValueError('X has a different number of features than '
+                                 'the previous fit.')
+            init = (self.a_, self.b_, self.w_)
+            results = [self._fit_trial(X, Y, seeds[0], init=init)]
+        elif n_jobs > 1:
+            results = self._fit_trials_parallel(X, Y, seeds, n_jobs)
+        else:
+            results = []
+            for trial, seed in enumerate(seeds):
+                logging.debug('Trial {}/{}'.format(trial + 1, self.n_restarts))
+                results.append(self._fit_trial(X, Y, seed))
 
-        a, b, w = max(results, key=lambda z: z[0])[1]
+        # max keeps the first of equal scores, as in the order of the trials.
+        _, (a, b, w), history = max(results, key=lambda z: z[0])
         self.a_ = a
         self.b_ = b
         self.w_ = w
+        self.history_ = history
+        self.n_samples_, self.n_dim_ = X.shape[0], X.shape[1] + 1
+        self.n_labellers_ = Y.shape[0]
+
+        # Starting point of partial_fit: the statistics of μ per sample.
+        x = numpy.hstack([X, numpy.ones((X.shape[0], 1))])
+        m = self._exp_m_step(a, b, w, x, Y)
+        self.statistics_ = self._sufficient_statistics(m, Y) / X.shape[0]
+        self.n_batches_ = 0
+        return self
+
+    def _fit_trial(self, X, Y, seed, init=None):
+        """Runs one restart.
+
+        init: (a, b, w) to start from, or None.
+        -> (log-likelihood, (a, b, w), history)
+        """
+        a, b, w = self._fit_params(X, Y, random_state=seed, init=init)
+        self.a_, self.b_, self.w_ = a, b, w
+        return self.score(X, Y), (a, b, w), self.history_
+
+    def _fit_trials_parallel(self, X, Y, seeds, n_jobs):
+        """Runs the restarts on a pool of processes.
 
-    def _fit_params(self, x, y):
+        X and Y are copied once to shared memory, which the workers read
+        without pickling them for each trial.
+        -> list of (log-likelihood, (a, b, w), history), in the order of the
+            seeds.
+        """
+        shared = (_to_shared(X, 'd'), X.shape,
+                  _to_shared(Y.labellers, 'q'), _to_shared(Y.samples, 'q'),
+                  _to_shared(Y.labels, 'd'), Y.shape)
+        params = self.get_params()
+        params['n_jobs'] = 1
+        # The callback may not be picklable, and would run in the workers.
+        params['callback'] = None
+        with multiprocessing.Pool(n_jobs, initializer=_init_shared_trial,
+                                  initargs=shared) as pool:
+            return pool.starmap(_fit_shared_trial,
+                                [(params, seed) for seed in seeds])
+
+    def _fit_params(self, x, y, random_state=None, init=None):
         """
         x: (n_samples, n_features) NumPy array of data (with no bias term).
-        y: (n_labellers, n_samples) NumPy masked array of crowd labels.
+        y: (n_labellers, n_samples) NumPy masked array of crowd labels, or
+            SparseLabels.
+        random_state: Seed or numpy.random.RandomState of this run. None uses
+            the global random state.
+        init: (a, b, w) to start from instead of the majority vote, or None.
         """
+        rng = sklearn.utils.check_random_state(random_state)
+        # Only the observed labels are stored, so the steps below only
+        # compute over the observed entries.
+        y = as_sparse_labels(y)
+
         # Add a bias feature.
         x = numpy.hstack([x, numpy.ones((x.shape[0], 1))])
 
@@ -72,89 +178,161 @@ class RaykarClassifier(object):
         self.n_labellers_ = n_labellers
         self.n_dim_ = n_dim
 
-        # Compute majority vote labels for initialisation.
-        mv = majority_vote(y)
-        m = mv.copy()
-        # Add a small random factor for variety.
-        m[m == 1] -= numpy.abs(numpy.random.normal(scale=1e-2,
-                                                   size=m[m == 1].shape[0]))
-        m[m == 0] += numpy.abs(numpy.random.normal(scale=1e-2,
-                                                   size=m[m == 0].shape[0]))
-
-        # Convert y into a dense array and a mask. Then we can ignore the mask
-        # when we don't need it and get nice fast code (numpy.ma is quite slow).
-        y_mask = y.mask
-        y_1 = y.filled(1)
-        y = y_0 = y.filled(0)
-
-        w = None
-        a = self._max_alpha_step(m, y, y_mask)
-        b = self._max_beta_step(m, y, y_mask)
-
-        while True:
+        if init is not None:
+            # μ of the previous parameters.
+            a, b, w = init
+            a = _resize_labellers(a, n_labellers)
+            b = _resize_labellers(b, n_labellers)
+            mv = None
+            m = self._exp_m_step(a, b, w, x, y)
+        else:
+            # Compute majority vote labels for initialisation.
+            mv = majority_vote(y, random_state=rng)
+            m = mv.copy()
+            # Add a small random factor for variety.
+            m[m == 1] -= numpy.abs(rng.normal(scale=1e-2,
+                                              size=m[m == 1].shape[0]))
+            m[m == 0] += numpy.abs(rng.normal(scale=1e-2,
+                                              size=m[m == 0].shape[0]))
+            w = None
+
+        a = self._max_alpha_step(m, y)
+        b = self._max_beta_step(m, y)
+
+        self.history_ = history = []
+        dm = numpy.inf
+        for iteration in range(self.max_iter):
             then = time.time()
             # Maximisation step.
             # w first, so the optimisation uses the old parameters.
-            w = self._max_w_step(a, b, m, x, y_0, y_1, mv, init_w=w)
-            a = self._max_alpha_step(m, y, y_mask)
-            b = self._max_beta_step(m, y, y_mask)
+            w = self._max_w_step(a, b, m, x, y, mv, init_w=w, rng=rng)
+            a = self._max_alpha_step(m, y)
+            b = self._max_beta_step(m, y)
 
             # Expectation step.
-            m_ = self._exp_m_step(a, b, w, x, y, y_mask)
-
-            logging.debug('Current value of delta mu: %f',
-                          numpy.linalg.norm(m_ - m))
-
-            dm = numpy.linalg.norm(m_ - m)
-            if dm < self.epsilon:
-                logging.debug('a: {}'.format(a))
-                logging.debug('b: {}'.format(b))
-                return a, b, w
-
+            log_a, log_b = self._log_label_likelihoods(a, b, y)
+            z = x.dot(w)
+            m_ = self._posterior(z, log_a, log_b)
+            ll = self._log_likelihood_z(z, log_a, log_b)
+
+            # Root mean square change, so that the threshold doesn't depend
+            # on the number of samples.
+            dm = numpy.linalg.norm(m_ - m) / numpy.sqrt(n_samples)
+            converged = dm < self.epsilon
+            if self.ll_tol is not None and history:
+                dll = abs(ll - history[-1]['log_likelihood']) / n_samples
+                converged = converged or dll < self.ll_tol
             m = m_
 
-            # Estimate time remaining.
-            now = time.time()
-            dt = now - then
-            logging.debug('Raykar iteration took {} s.'.format(dt))
+            record = {'iteration': iteration, 'time': time.time() - then,
+                      'delta': dm, 'log_likelihood': ll}
+            history.append(record)
+            logging.debug('Raykar iteration {iteration} took {time} s, '
+                          'delta mu {delta}, log-likelihood '
+                          '{log_likelihood}.'.format(**record))
+            if self.callback is not None and self.callback(record):
+                break
+            if converged:
+                break
+        else:
+            warnings.warn('Raykar EM did not converge in {} iterations '
+                          '(delta mu {}).'.format(self.max_iter, dm),
+                          sklearn.exceptions.ConvergenceWarning)
+
+        logging.debug('a: {}'.format(a))
+        logging.debug('b: {}'.format(b))
+        return a, b, w
 
-    def _exp_m_step(self, a, b, w, x, y, y_mask):
+    def _exp_m_step(self, a, b, w, x, y):
         """Computes expectation value of μ."""
-        lr = logistic_regression(w, x)
-        exp_a = numpy.ones((x.shape[0],))
-        exp_b = numpy.ones((x.shape[0],))
-        for t in range(a.shape[0]):
-            for i in range(x.shape[0]):
-                if y_mask[t, i]:
-                    continue
-
-                exp_a[i] *= a[t] ** y[t, i] * (1 - a[t]) ** (1 - y[t, i])
-                exp_b[i] *= b[t] ** (1 - y[t, i]) * (1 - b[t]) ** y[t, i]
-
-        logging.debug('Average a_i: {:.02}'.format(exp_a.mean()))
+        log_a, log_b = self._log_label_likelihoods(a, b, y)
+
+        logging.debug('Average a_i: {:.02}'.format(numpy.exp(log_a).mean()))
         logging.debug('Average alpha_t: {:.02}'.format(a.mean()))
         logging.debug('Max alpha_t: {}'.format(a.max()))
         logging.debug('Min alpha_t: {}'.format(a.min()))
 
-        return exp_a * lr / (exp_a * lr + exp_b * (1 - lr) + EPS)
+        return self._posterior(x.dot(w), log_a, log_b)
+
+    def _posterior(self, z, log_a, log_b):
+        """Computes p(z_i = 1 | x_i, y_i) in log space.
+
+        z: (n_samples,) array of logistic regression logits x_i . w.
+        log_a, log_b: Log-likelihoods of the crowd labels of each sample.
+        -> (n_samples,) NumPy array.
+        """
+        with numpy.errstate(invalid='ignore'):
+            logit = z + log_a - log_b
+        # Samples with labels impossible under both classes keep the prior.
+        logit = numpy.where(numpy.isnan(logit), z, logit)
+        return scipy.special.expit(logit)
+
+    def _log_label_likelihoods(self, a, b, y):
+        """Computes the log-likelihood of the crowd labels of each sample.
+
+        a: (n_labellers,) array of labeller true positive rates.
+        b: (n_labellers,) array of labeller true negative rates.
+        y: SparseLabels.
+        -> log Π_t p(y_ti | z_i = 1), log Π_t p(y_ti | z_i = 0); each a
+            (n_samples,) NumPy array. Unobserved labels contribute nothing.
+        """
+        n_samples = y.shape[1]
+        a = a[y.labellers]
+        b = b[y.labellers]
+        with numpy.errstate(divide='ignore'):
+            log_a = numpy.log(a ** y.labels * (1 - a) ** (1 - y.labels))
+            log_b = numpy.log(b ** (1 - y.labels) * (1 - b) ** y.labels)
+        log_a = numpy.bincount(y.samples, weights=log_a, minlength=n_samples)
+        log_b = numpy.bincount(y.samples, weights=log_b, minlength=n_samples)
+        return log_a, log_b
+
+    def _neg_log_likelihood_w(self, w, x, log_a, log_b):
+        """Computes the negative log-likelihood as a function of w.
+
+        w: (n_features,) array of weights.
+        x: (n_samples, n_features) NumPy array of examples.
+        log_a, log_b: Log-likelihoods of the crowd labels of each sample.
+        -> (negative log-likelihood, gradient w.r.t. w)
+        """
+        z = x.dot(w)
+        ll = self._log_likelihood_z(z, log_a, log_b)
+        # d/dz log(p A + (1 - p) B) = μ - p
+        grad = x.T.dot(self._posterior(z, log_a, log_b) -
+                       scipy.special.expit(z))
+        return -ll, -grad
+
+    def _log_likelihood_z(self, z, log_a, log_b):
+        """Computes the log-likelihood from the logits z = x . w."""
+        return numpy.logaddexp(log_a - numpy.logaddexp(0, -z),
+                               log_b - numpy.logaddexp(0, z)).sum()
+
+    def _neg_log_likelihood_w_hessian(self, w, x, log_a, log_b):
+        """Computes the Hessian of the negative log-likelihood w.r.t. w."""
+        z = x.dot(w)
+        m = self._posterior(z, log_a, log_b)
+        p = scipy.special.expit(z)
+        # d/dz (μ - p) = μ (1 - μ) - p (1 - p)
+        d = m * (1 - m) - p * (1 - p)
+        return -(x.T * d).dot(x)
 
     def _hessian_inverse_multiply(self, x, H, g):
         return numpy.linalg.norm(H.dot(x) - g)
 
-    def _max_w_step(self, a, b, m, x, y_0, y_1, mv, init_w=None):
+    def _max_w_step(self, a, b, m, x, y, mv, init_w=None, rng=numpy.random):
         """Computes w based on μ.
 
         m: μ
         x: (n_samples, n_features) NumPy array of examples.
-        y_0, y_1: Array of crowd labels filled with 0 or 1.
+        y: SparseLabels of crowd labels.
         mv: Majority vote of labels.
         init_w: Initial value of w.
+        rng: Random state used to initialise w if lr_init is False.
         -> w
         """
         n_samples, n_features = x.shape
 
         if init_w is None and not self.lr_init:
-            w = numpy.random.normal(size=(x.shape[1],))
+            w = rng.normal(size=(x.shape[1],))
         elif init_w is None:
             lr = sklearn.linear_model.LogisticRegression(
                     class_weight='balanced', fit_intercept=False)
@@ -163,50 +341,161 @@ class RaykarClassifier(object):
         else:
             w = init_w
 
-        w = scipy.optimize.fmin_bfgs(self._log_likelihood, w,
-                                     args=(a.reshape((-1, 1)),
-                                           b.reshape((-1, 1)), x, y_0, y_1),
-                                     disp=False)
-        return w
+        # The crowd label terms don't depend on w.
+        log_a, log_b = self._log_label_likelihoods(a, b, y)
+        hess = None
+        if self.optimiser.lower() in HESSIAN_OPTIMISERS:
+            hess = self._neg_log_likelihood_w_hessian
+        res = scipy.optimize.minimize(self._neg_log_likelihood_w, w,
+                                      args=(x, log_a, log_b), jac=True,
+                                      hess=hess, method=self.optimiser)
+        return res.x
+
+    def partial_fit(self, X, Y, batch_size=1000, kappa=0.7):
+        """Updates the model with new samples by stepwise EM.
+
+        The samples are processed by mini-batches. Each batch gets μ from
+        the current parameters, then the statistics of the labellers are
+        moved towards the ones of the batch with the step size
+        (n / (N + n)) ** kappa, n being the number of samples of the batch and
+        N the number of samples seen (including the ones of fit), and w
+        towards the optimum of the batch. The previous samples are not
+        needed.
+
+        X: (n_samples, n_features) NumPy array of the new data.
+        Y: (n_labellers, n_samples) NumPy masked array of crowd labels of the
+            new samples, or SparseLabels. The labellers are the same as in
+            the previous fits, new ones being added at the end.
+        batch_size: Number of samples of each batch.
+        kappa: Decay of the step size, in (0.5, 1]. With 1, the statistics
+            are the average over all the samples seen; a smaller kappa gives
+            more weight to the recent samples.
+        """
+        Y = as_sparse_labels(Y)
+        if X.shape[0] != Y.shape[1]:
+            raise ValueError('X and Y have different numbers of samples.')
+        x = numpy.hstack([X, numpy.ones((X.shape[0], 1))])
+        n_samples = x.shape[0]
+        n_labellers = Y.shape[0]
+
+        if getattr(self, 'w_', None) is None:
+            # First call: initialise from the majority vote of these samples.
+            rng = sklearn.utils.check_random_state(self.random_state)
+            mv = majority_vote(Y, random_state=rng)
+            self.statistics_ = self._sufficient_statistics(mv, Y) / n_samples
+            self.a_, self.b_ = self._params_from_statistics(self.statistics_)
+            self.w_ = self._max_w_step(self.a_, self.b_, mv, x, Y, mv,
+                                       rng=rng)
+            self.n_batches_ = 0
+            self.n_samples_ = 0
+        elif self.w_.shape[0] != x.shape[1]:
+            raise ValueError('X has a different number of features than the '
+                             'previous fit.')
+
+        n_labellers = max(n_labellers, self.statistics_.shape[1])
+        self.statistics_ = numpy.hstack([
+                self.statistics_,
+                numpy.zeros((4, n_labellers - self.statistics_.shape[1]))])
+        self.a_ = _resize_labellers(self.a_, n_labellers)
+        self.b_ = _resize_labellers(self.b_, n_labellers)
+
+        # The labels sorted by sample, to cut the batches.
+        order = numpy.argsort(Y.samples, kind='stable')
+        samples = Y.samples[order]
+        for start in range(0, n_samples, batch_size):
+            stop = min(start + batch_size, n_samples)
+            lo, hi = numpy.searchsorted(samples, [start, stop])
+            batch = order[lo:hi]
+            y = SparseLabels(Y.labellers[batch], samples[lo:hi] - start,
+                             Y.labels[batch], shape=(n_labellers, stop - start))
+            xb = x[start:stop]
+            n_batch = stop - start
+
+            m = self._exp_m_step(self.a_, self.b_, self.w_, xb, y)
+            # The step depends on the number of samples the statistics
+            # already cover, so that a small batch after a fit on many
+            # samples only moves them a little.
+            step = (n_batch / (self.n_samples_ + n_batch)) ** kappa
+            self.statistics_ = ((1 - step) * self.statistics_ +
+                                step * self._sufficient_statistics(m, y) /
+                                n_batch)
+            self.a_, self.b_ = self._params_from_statistics(self.statistics_)
+            w = self._max_w_step(self.a_, self.b_, m, xb, y, None,
+                                 init_w=self.w_)
+            self.w_ = (1 - step) * self.w_ + step * w
+            self.n_batches_ += 1
+            self.n_samples_ += n_batch
+
+        self.n_dim_ = x.shape[1]
+        self.n_labellers_ = n_labellers
+        return self
+
+    def _sufficient_statistics(self, m, y):
+        """Computes the statistics of the labellers that α and β depend on.
+
+        m: μ
+        y: SparseLabels of crowd labels.
+        -> (4, n_labellers) NumPy array of Σ μ y, Σ μ, Σ (1 - μ)(1 - y) and
+            Σ (1 - μ) over the labels of each labeller.
+        """
+        n_labellers = y.shape[0]
+        m = m[y.samples]
+        return numpy.array([
+                numpy.bincount(y.labellers, weights=m * y.labels,
+                               minlength=n_labellers),
+                numpy.bincount(y.labellers, weights=m,
+                               minlength=n_labellers),
+                numpy.bincount(y.labellers,
+                               weights=(1 - m) * (1 - y.labels),
+                               minlength=n_labellers),
+                numpy.bincount(y.labellers, weights=1 - m,
+                               minlength=n_labellers),
+        ])
+
+    def _params_from_statistics(self, statistics):
+        """-> α, β of the statistics of _sufficient_statistics.
 
-    def _max_alpha_step(self, m, y, y_mask):
+        A labeller without statistics yet (for example one whose first
+        labels are in a later batch) gets 0.5, as in _resize_labellers.
+        """
+        a = numpy.full(statistics.shape[1], 0.5)
+        b = numpy.full(statistics.shape[1], 0.5)
+        known_a = statistics[1] > 0
+        known_b = statistics[3] > 0
+        a[known_a] = statistics[0, known_a] / statistics[1, known_a]
+        b[known_b] = statistics[2, known_b] / statistics[3, known_b]
+        return a, b
+
+    def _max_alpha_step(self, m, y):
         """Computes α based on μ.
 
         m: μ
-        y: Array of crowd labels.
-        y_mask: Mask of unobserved crowd labels.
+        y: SparseLabels of crowd labels.
         -> α
         """
-        a = numpy.zeros((y.shape[0],))
-        divisor = numpy.zeros((y.shape[0],))
-        for t in range(y.shape[0]):
-            for i in range(y.shape[1]):
-                if y_mask[t, i]:
-                    continue
-
-                a[t] += m[i] * y[t, i]
-                divisor[t] += m[i]
+        n_labellers = y.shape[0]
+        m = m[y.samples]
+        a = numpy.bincount(y.labellers, weights=m * y.labels,
+                           minlength=n_labellers)
+        divisor = numpy.bincount(y.labellers, weights=m,
+                                 minlength=n_labellers)
 
         divisor[divisor == 0] = EPS
         return a / divisor
 
-    def _max_beta_step(self, m, y, y_mask):
+    def _max_beta_step(self, m, y):
         """Computes β based on μ.
 
         m: μ
-        y: Array of crowd labels.
-        y_mask: Mask of unobserved crowd labels.
+        y: SparseLabels of crowd labels.
         -> β
         """
-        b = numpy.zeros((y.shape[0],))
-        divisor = numpy.zeros((y.shape[0],))
-        for t in range(y.shape[0]):
-            for i in range(y.shape[1]):
-                if y_mask[t, i]:
-                    continue
-
-                b[t] += (1 - m[i]) * (1 - y[t, i])
-                divisor[t] += (1 - m[i])
+        n_labellers = y.shape[0]
+        m = m[y.samples]
+        b = numpy.bincount(y.labellers, weights=(1 - m) * (1 - y.labels),
+                           minlength=n_labellers)
+        divisor = numpy.bincount(y.labellers, weights=1 - m,
+                                 minlength=n_labellers)
 
         divisor[divisor == 0] = EPS
         return b / divisor
@@ -219,41 +508,41 @@ class RaykarClassifier(object):
         return logistic_regression(self.w_, X)
 
     def score(self, X, Y):
-        """Computes the likelihood of labels and data under the model.
+        """Computes the log-likelihood of labels and data under the model.
 
         X: (n_samples, n_features) NumPy array of data.
-        Y: (n_labellers, n_samples) NumPy masked array of crowd labels.
+        Y: (n_labellers, n_samples) NumPy masked array of crowd labels, or
+            SparseLabels.
         """
         X = numpy.hstack([X, numpy.ones((X.shape[0], 1))])
-        return self._likelihood(self.w_, self.a_.reshape((-1, 1)),
-                                self.b_.reshape((-1, 1)), X, Y.filled(0),
-                                Y.filled(1))
+        return self._log_likelihood(self.w_, self.a_, self.b_, X,
+                                    as_sparse_labels(Y))
 
-    def _log_likelihood(self, *args, **kwargs):
-        return numpy.log(self._likelihood(*args, **kwargs) + EPS)
+    def _log_likelihood(self, w, a, b, X, Y):
+        """Computes the log-likelihood of labels and data under a model.
 
-    def _likelihood(self, w, a, b, X, Y_0, Y_1):
-        """Computes the likelihood of labels and data under a model.
+        The sum over samples is done in log space, so it doesn't underflow
+        for large datasets.
 
         X: (n_samples, n_features) NumPy array of data.
-        Y: (n_labellers, n_samples) NumPy masked array of crowd labels.
+        Y: SparseLabels of crowd labels.
         """
-        n_examples = X.shape[0]
-        exp_p = logistic_regression(w, X)
-        exp_a = numpy.ones((n_examples,))
-        exp_b = numpy.ones((n_examples,))
-        exp_a = numpy.power(a, Y_0).prod(axis=0)
-        exp_a *= numpy.power(1 - a, 1 - Y_1).prod(axis=0)
-        exp_b *= numpy.power(b, 1 - Y_1).prod(axis=0)
-        exp_b *= numpy.power(1 - b, Y_0).prod(axis=0)
-
-        return (exp_a * exp_p.T + exp_b * (1 - exp_p).T).prod()
+        log_a, log_b = self._log_label_likelihoods(a, b, Y)
+        nll, _ = self._neg_log_likelihood_w(w, X, log_a, log_b)
+        return -nll
 
     def get_params(self, deep=True):
         return {
             'n_restarts': self.n_restarts,
             'epsilon': self.epsilon,
             'lr_init': self.lr_init,
+            'optimiser': self.optimiser,
+            'n_jobs': self.n_jobs,
+            'random_state': self.random_state,
+            'max_iter': self.max_iter,
+            'll_tol': self.ll_tol,
+            'callback': self.callback,
+            'warm_start': self.warm_start,
         }
 
     def set_params(self, **parameters):
@@ -280,3 +569,38 @@ class RaykarClassifier(object):
         rc.b_ = array[n_annotators:n_annotators * 2]
         rc.w_ = array[n_annotators * 2:]
         return rc
+
+
+def _resize_labellers(params, n_labellers):
+    """Pads the parameters of the labellers with 0.5 (labels that tell
+    nothing) for new labellers, or cuts them."""
+    params = params[:n_labellers]
+    return numpy.concatenate([params,
+                              numpy.full(n_labellers - len(params), 0.5)])
+
+
+# X and Y of the parallel restarts, in the shared memory of a worker process.
+_shared_trial = {}
+
+
+def _to_shared(array, typecode):
+    """Copies a NumPy array to a flat multiprocessing.RawArray."""
+    shared = multiprocessing.RawArray(typecode, array.size)
+    dtype = numpy.float64 if typecode == 'd' else numpy.int64
+    numpy.frombuffer(shared, dtype=dtype)[:] = array.ravel()
+    return shared
+
+
+def _init_shared_trial(x, x_shape, labellers, samples, labels, y_shape):
+    """Initialises a worker process with views of the shared X and Y."""
+    _shared_trial['X'] = numpy.frombuffer(x).reshape(x_shape)
+    _shared_trial['Y'] = SparseLabels(
+            numpy.frombuffer(labellers, dtype=numpy.int64),
+            numpy.frombuffer(samples, dtype=numpy.int64),
+            numpy.frombuffer(labels), shape=y_shape, presorted=True)
+
+
+def _fit_shared_trial(params, seed):
+    """Runs one restart in a worker process on the shared X and Y."""
+    rc = RaykarClassifier(**params)
+    return rc._fit_trial(_shared_trial['X'], _shared_trial['Y'], seed)
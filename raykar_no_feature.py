@@ -1,106 +1,246 @@
-import numpy
-import math
-import sklearn
-import time
-
-class RaykarClassifier(object):
-    """Classifier based on the Raykar et al. (2010) EM algorithm.
-
-    Jointly learns an annotator model and a classification model.
-    """
-
-    def __init__(self, n_restarts=5, epsilon=1e-5):
-        """
-        n_restarts: Number of times to run the algorithm. Higher numbers improve
-            chances of finding a global maximum likelihood solution.
-        epsilon: Convergence threshold.
-        lr_init: Whether to initialise w using logistic regression.
-        """
-        self.n_restarts = n_restarts
-        self.epsilon = epsilon
-
-    def init_parameters(self, mv, y, y_labels):
-        """
-
-        :param mv: list of results of majority of voting
-        :param y: (n_workers, m_labels)
-        :param y_labels: list of labels
-        :return:
-        """
-        self.mv = mv
-        self.y = y
-        self.y_labels = y_labels
+"""Dawid and Skene (1979) EM crowd labelling algorithm, without features.
 
-    def run(self, mv, y):
-        m = mv.copy()
-        # Add a small random factor for variety.
-        m[m == 1] -= numpy.abs(numpy.random.normal(scale=1e-2,
-                                                   size=m[m == 1].shape[0]))
-        m[m == 0] += numpy.abs(numpy.random.normal(scale=1e-2,
-                                                   size=m[m == 0].shape[0]))
+Each item has its own set of candidate answers (the normalized propositions
+of a label), and each labeller a reliability: the probability that their
+answer is the true one. A wrong answer is any of the other candidates of the
+item with the same probability (the "one-coin" model).
 
-        # Convert y into a dense array and a mask. Then we can ignore the mask
-        # when we don't need it and get nice fast code (numpy.ma is quite slow).
-        y_mask = y.mask
-        y_1 = y.filled(1)
-        y = y_0 = y.filled(0)
-        iter_results = []
-        for trial in range(self.n_restarts):
-            a = numpy.zeros((y.shape[0],), dtype=float)
-            m_new = numpy.zeros((m.shape[0],), dtype=float)
+The candidates of all the items are stored flattened, the candidates of item
+i being offsets[i]:offsets[i] + n_candidates[i], so each step is a few
+bincounts and reduceats over the observed labels.
+"""
 
-            while True:
-                then = time.time()
+import logging
+import time
+import warnings
 
-                a = self.m_step(m, y, y_mask)
-                m_new = self.e_step(a, m, y, y_mask)
-                dm = numpy.linalg.norm(m_new - m)
+import numpy
+import sklearn.exceptions
 
-                if dm < self.epsilon:
-                    iter_results.append((a, m_new))
+from util import as_sparse_labels
 
-                m = m_new
+EPS = 1E-8
 
-                # Estimate time remaining.
-                now = time.time()
-                dt = now - then
-                print('Raykar iteration took {} s.'.format(dt))
 
+class DawidSkeneClassifier(object):
+    """Classifier based on the one-coin Dawid and Skene (1979) EM algorithm.
 
+    Jointly learns the reliability of the labellers and the posterior of the
+    candidates of each item.
+    """
 
-    def m_step(self, m, y, y_mask):
+    def __init__(self, epsilon=1e-5, max_iter=100, smoothing=1.0,
+                 prior=None, ll_tol=None, callback=None):
         """
-        :param pr:
-        :param y: (n_labllers, m_examples)
-        :return:
+        epsilon: Convergence threshold on the root mean square change of the
+            posteriors of the items.
+        max_iter: Maximum number of EM iterations. A ConvergenceWarning is
+            raised if it is reached.
+        smoothing: Each labeller gets 2 * smoothing pseudo-answers, right
+            with the probability prior, so that the reliabilities stay in
+            (0, 1) and the labellers with few answers are close to prior.
+        prior: Reliability of a labeller without answers. None for the
+            pooled reliability of all the labellers, so that sparse
+            labellers who agree are not pulled towards chance.
+        ll_tol: Also stop when the log-likelihood per item changes by less
+            than ll_tol between two iterations. None to only use epsilon.
+        callback: Function called after each iteration with the record of
+            the iteration (see history_); returning True stops the fit.
+
+        After fit, history_ is the list of the iterations, each a dict with
+        the iteration number, its time in seconds, the change of the
+        posteriors (delta) and the log-likelihood.
         """
-        a = numpy.zeros((y.shape[0],), dtype=float)
-        reciprocal = numpy.ones((y.shape[0]))
-        for t in range(y.shape[0]):
-            for i in range(y.shape[1]):
-                if y_mask[t, i]:
-                    continue
-
-                a[t] += (m[i] - y[t, i]) * (m[i] - y[t, i])
-                # divisor[t] += m[i]
-
-        # divisor[divisor == 0] = EPS
-        return reciprocal / (a / y.shape[1])
+        self.epsilon = epsilon
+        self.max_iter = max_iter
+        self.smoothing = smoothing
+        self.prior = prior
+        self.ll_tol = ll_tol
+        self.callback = callback
 
-    def e_step(self, a, m, y, y_mask):
+    def fit(self, Y, n_candidates=None):
         """
-
-        :return:
+        Y: (n_labellers, n_items) NumPy masked array of the codes of the
+            candidates given by the labellers, or SparseLabels (or anything
+            accepted by util.as_sparse_labels). The codes of item i are
+            0 to n_candidates[i] - 1.
+        n_candidates: (n_items,) array of the number of candidates of each
+            item. Inferred from the largest code of each item if None.
+        """
+        Y = as_sparse_labels(Y)
+        codes = Y.labels.astype(numpy.intp)
+        n_labellers, n_items = Y.shape
+        if n_candidates is None:
+            n_candidates = numpy.zeros(n_items, dtype=numpy.intp)
+            numpy.maximum.at(n_candidates, Y.samples, codes + 1)
+        n_candidates = numpy.asarray(n_candidates, dtype=numpy.intp)
+        if n_candidates.shape != (n_items,):
+            raise ValueError('n_candidates must have one value per item.')
+        if (codes >= n_candidates[Y.samples]).any():
+            raise ValueError('Y has codes out of the candidates of an item.')
+        # Items without any candidate get one, which is never observed.
+        n_candidates = numpy.maximum(n_candidates, 1)
+
+        offsets = numpy.zeros(n_items, dtype=numpy.intp)
+        numpy.cumsum(n_candidates[:-1], out=offsets[1:])
+        self.n_candidates_ = n_candidates
+        self.offsets_ = offsets
+        self.n_labellers_ = n_labellers
+        self.n_items_ = n_items
+
+        # Index of the candidate given by each label in the flat arrays.
+        given = offsets[Y.samples] + codes
+        q = self._majority_posterior(Y, given)
+        self.history_ = history = []
+        dq = numpy.inf
+        for iteration in range(self.max_iter):
+            then = time.time()
+            r = self._max_reliability_step(q, Y, given)
+            q_, ll = self._exp_step(r, Y, given)
+            # Root mean square change per item, so that the threshold
+            # doesn't depend on the number of items.
+            dq = numpy.linalg.norm(q_ - q) / numpy.sqrt(max(n_items, 1))
+            converged = dq < self.epsilon
+            if self.ll_tol is not None and history:
+                dll = abs(ll - history[-1]['log_likelihood']) / n_items
+                converged = converged or dll < self.ll_tol
+            q = q_
+
+            record = {'iteration': iteration, 'time': time.time() - then,
+                      'delta': dq, 'log_likelihood': ll}
+            history.append(record)
+            logging.debug('Dawid-Skene iteration {iteration} took {time} s, '
+                          'delta q {delta}, log-likelihood '
+                          '{log_likelihood}.'.format(**record))
+            if self.callback is not None and self.callback(record):
+                break
+            if converged:
+                break
+        else:
+            warnings.warn('Dawid-Skene EM did not converge in {} iterations '
+                          '(delta q {}).'.format(self.max_iter, dq),
+                          sklearn.exceptions.ConvergenceWarning)
+
+        self.reliability_ = self._max_reliability_step(q, Y, given)
+        self.posterior_ = q
+        return self
+
+    def _majority_posterior(self, Y, given):
+        """Initialises the posteriors with the share of votes of each
+        candidate."""
+        counts = numpy.bincount(given, minlength=self.n_candidates_.sum())
+        totals = numpy.repeat(numpy.add.reduceat(counts, self.offsets_),
+                              self.n_candidates_).astype(float)
+        # Uniform for the items without labels.
+        unlabelled = totals == 0
+        totals[unlabelled] = 1
+        q = counts / totals
+        q[unlabelled] = 1.0 / numpy.repeat(self.n_candidates_,
+                                           self.n_candidates_)[unlabelled]
+        return q
+
+    def _max_reliability_step(self, q, Y, given):
+        """Computes the reliability of each labeller based on the posteriors.
+
+        Only the items with several candidates tell anything about the
+        labellers.
+        -> (n_labellers,) NumPy array.
+        """
+        informative = self.n_candidates_[Y.samples] > 1
+        right = numpy.bincount(Y.labellers, weights=q[given] * informative,
+                               minlength=self.n_labellers_)
+        total = numpy.bincount(Y.labellers, weights=informative,
+                               minlength=self.n_labellers_)
+        prior = self.prior
+        if prior is None:
+            prior = (right.sum() + self.smoothing) / (total.sum() +
+                                                       2 * self.smoothing)
+        return ((right + 2 * self.smoothing * prior) /
+                (total + 2 * self.smoothing + EPS))
+
+    def _log_joint(self, r, Y, given):
+        """Computes log p(z_i = c, y_i) for each candidate c of each item,
+        with a uniform prior on the candidates.
+
+        -> flat NumPy array of the candidates.
+        """
+        n_candidates = self.n_candidates_
+        k = n_candidates[Y.samples]
+        informative = k > 1
+        r = numpy.clip(r[Y.labellers], EPS, 1 - EPS)
+        log_right = numpy.where(informative, numpy.log(r), 0)
+        log_wrong = numpy.where(
+                informative,
+                numpy.log((1 - r) / numpy.maximum(k - 1, 1)), 0)
+        # Every label is wrong for all the candidates but the one it gives.
+        wrong = numpy.bincount(Y.samples, weights=log_wrong,
+                               minlength=self.n_items_)
+        log_joint = numpy.repeat(wrong - numpy.log(n_candidates),
+                                 n_candidates)
+        log_joint += numpy.bincount(given, weights=log_right - log_wrong,
+                                    minlength=len(log_joint))
+        return log_joint
+
+    def _log_evidence(self, log_joint):
+        """Computes log p(y_i) of each item with a logsumexp over its
+        candidates."""
+        offsets = self.offsets_
+        top = numpy.maximum.reduceat(log_joint, offsets)
+        shifted = numpy.exp(log_joint - numpy.repeat(top, self.n_candidates_))
+        return top + numpy.log(numpy.add.reduceat(shifted, offsets))
+
+    def _exp_step(self, r, Y, given):
+        """Computes the posteriors p(z_i = c | y_i) of the candidates.
+
+        -> (flat NumPy array of the posteriors, log-likelihood)
+        """
+        log_joint = self._log_joint(r, Y, given)
+        log_evidence = self._log_evidence(log_joint)
+        q = numpy.exp(log_joint - numpy.repeat(log_evidence,
+                                               self.n_candidates_))
+        return q, log_evidence.sum()
+
+    def predict(self):
+        """-> (n_items,) NumPy array of the code of the most probable
+        candidate of each item."""
+        return self._argmax_per_item(self.posterior_)
+
+    def predict_proba(self):
+        """-> list of the (n_candidates[i],) NumPy arrays of the posteriors
+        of the candidates of each item."""
+        return numpy.split(self.posterior_, self.offsets_[1:])
+
+    def _argmax_per_item(self, values):
+        top = numpy.maximum.reduceat(values, self.offsets_)
+        is_top = values == numpy.repeat(top, self.n_candidates_)
+        # The first candidate reaching the maximum of each item.
+        index = numpy.flatnonzero(is_top)
+        item = numpy.repeat(numpy.arange(self.n_items_),
+                            self.n_candidates_)[index]
+        first = numpy.unique(item, return_index=True)[1]
+        return index[first] - self.offsets_
+
+    def score(self, Y):
+        """Computes the log-likelihood of the labels under the model.
+
+        Y: Crowd labels with the same items and candidates as in fit.
         """
-        m_new = numpy.zeros((m.shape[0],), dtype=float)
-        for i in range(m.shape[0]):
-            sum_a = numpy.sum(a)
-            for j in range(a.shape[0]):
-                if y_mask[i, j]:
-                    continue
-                m_new[i] += a[j] * y[i, j] / sum_a
-        return m_new
-
-
-if __name__ == '__main__':
-    print()
+        Y = as_sparse_labels(Y)
+        given = self.offsets_[Y.samples] + Y.labels.astype(numpy.intp)
+        log_joint = self._log_joint(self.reliability_, Y, given)
+        return self._log_evidence(log_joint).sum()
+
+    def get_params(self, deep=True):
+        return {
+            'epsilon': self.epsilon,
+            'max_iter': self.max_iter,
+            'smoothing': self.smoothing,
+            'prior': self.prior,
+            'll_tol': self.ll_tol,
+            'callback': self.callback,
+        }
+
+    def set_params(self, **parameters):
+        for parameter, value in parameters.items():
+            setattr(self, parameter, value)
+        return self
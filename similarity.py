@@ -0,0 +1,337 @@
+"""
+Similarity backends for the lossy comparison of the propositions.
+
+A backend tells if two strings are similar enough to be grouped. The strings
+are first prepared once (backend.prepare), then a matcher is built for each
+new proposition (backend.matcher) and called with the prepared keys of the
+groups it is compared with. Most comparisons are far from the threshold, so
+each backend rejects them with cheap bounds first.
+"""
+
+import argparse
+import collections
+import difflib as df
+import time
+
+
+class SimilarityBackend(object):
+    """
+        Interface of the similarity backends. calls counts the full
+        comparisons, the ones which were not rejected by the bounds.
+    """
+    name = None
+    calls = 0
+
+    def prepare(self, s):
+        """
+        :param s: the string, already normalized
+        :return: what the matchers need to know about the string
+        """
+        return s
+
+    def matcher(self, prepared2, threshold):
+        """
+        :param prepared2: the prepared proposition
+        :param threshold: the similarity needed to match
+        :return: function of a prepared key returning True if the key and the
+        proposition match
+        """
+        raise NotImplementedError
+
+    def similarity(self, s1, s2):
+        """
+        :return: the similarity of two strings, between 0 and 1
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return self.name
+
+
+class DifflibSimilarity(SimilarityBackend):
+    """
+        The ratio of difflib.SequenceMatcher. The pairs which can not reach
+        the threshold are rejected with the upper bounds of real_quick_ratio
+        (lengths) and quick_ratio (characters in common) first.
+    """
+    name = "difflib"
+
+    def prepare(self, s):
+        return s, len(s), collections.Counter(s)
+
+    def matcher(self, prepared2, threshold):
+        s2, len2, count2 = prepared2
+        # The SequenceMatcher caches the information on its second sequence,
+        # so it is built only once for each proposition
+        sequenceMatcher = df.SequenceMatcher(None)
+        sequenceMatcher.set_seq2(s2)
+
+        def match(prepared1):
+            s1, len1, count1 = prepared1
+            length = len1 + len2
+            if length:
+                if 2.0 * min(len1, len2) / length < threshold:
+                    return False
+                common = 0
+                for c, n in count1.items():
+                    common += min(n, count2[c])
+                if 2.0 * common / length < threshold:
+                    return False
+            self.calls += 1
+            sequenceMatcher.set_seq1(s1)
+            return sequenceMatcher.ratio() >= threshold
+        return match
+
+    def similarity(self, s1, s2):
+        return df.SequenceMatcher(None, s1, s2).ratio()
+
+
+def bounded_levenshtein(s1, s2, bound):
+    """
+    Levenshtein distance of two strings, computed only in the band of width
+    2 * bound around the diagonal, and stopped as soon as it exceeds bound.
+    :param s1: first string
+    :param s2: second string
+    :param bound: the maximum distance of interest
+    :return: the distance, or bound + 1 if it is larger than bound
+    """
+    if len(s1) > len(s2):
+        s1, s2 = s2, s1
+    len1, len2 = len(s1), len(s2)
+    if len2 - len1 > bound:
+        return bound + 1
+    # The common prefix and suffix do not change the distance
+    start = 0
+    while start < len1 and s1[start] == s2[start]:
+        start += 1
+    while len1 > start and s1[len1 - 1] == s2[len2 - 1]:
+        len1 -= 1
+        len2 -= 1
+    s1 = s1[start:len1]
+    s2 = s2[start:len2]
+    len1, len2 = len(s1), len(s2)
+    if not len1:
+        return len2 if len2 <= bound else bound + 1
+
+    over = bound + 1
+    previous = [j if j <= bound else over for j in range(len2 + 1)]
+    for i in range(1, len1 + 1):
+        c1 = s1[i - 1]
+        current = [over] * (len2 + 1)
+        if i <= bound:
+            current[0] = i
+        row_min = current[0]
+        for j in range(max(1, i - bound), min(len2, i + bound) + 1):
+            d = previous[j - 1] + (c1 != s2[j - 1])
+            if previous[j] + 1 < d:
+                d = previous[j] + 1
+            if current[j - 1] + 1 < d:
+                d = current[j - 1] + 1
+            if d > over:
+                d = over
+            current[j] = d
+            if d < row_min:
+                row_min = d
+        if row_min > bound:
+            return over
+        previous = current
+    return previous[len2]
+
+
+class LevenshteinSimilarity(SimilarityBackend):
+    """
+        1 - Levenshtein distance / length of the longest string. The distance
+        is bounded by the threshold, so that the pairs which can not match
+        are rejected early.
+    """
+    name = "levenshtein"
+
+    def matcher(self, s2, threshold):
+        def match(s1):
+            longest = max(len(s1), len(s2))
+            if not longest:
+                return True
+            # small tolerance so that the float rounding does not lose a match
+            bound = int((1.0 - threshold) * longest + 1e-9)
+            self.calls += 1
+            return bounded_levenshtein(s1, s2, bound) <= bound
+        return match
+
+    def similarity(self, s1, s2):
+        longest = max(len(s1), len(s2))
+        if not longest:
+            return 1.0
+        return 1.0 - bounded_levenshtein(s1, s2, longest) / float(longest)
+
+
+def qgrams(s, q=2):
+    """
+    :return: the set of the substrings of length q of s, or {s} if s is
+    shorter than q
+    """
+    if len(s) <= q:
+        return {s}
+    return {s[i:i + q] for i in range(len(s) - q + 1)}
+
+
+def jaccard(a, b):
+    """
+    :return: the Jaccard similarity of two sets
+    """
+    union = len(a | b)
+    if not union:
+        return 1.0
+    return len(a & b) / float(union)
+
+
+class QGramPrefilter(SimilarityBackend):
+    """
+        Rejects the pairs whose Jaccard similarity of their q-grams is below
+        min_jaccard, and asks the backend for the others. The q-grams are
+        sets, so the filter is cheap, but it is a heuristic: it can reject
+        pairs that the backend would have matched.
+    """
+    name = "qgram"
+
+    def __init__(self, backend=None, q=2, min_jaccard=0.5):
+        """
+        :param backend: the backend checking the pairs passing the filter,
+        LevenshteinSimilarity by default
+        :param q: length of the q-grams
+        :param min_jaccard: Jaccard similarity needed to pass the filter
+        """
+        self.backend = backend if backend is not None else LevenshteinSimilarity()
+        self.q = q
+        self.min_jaccard = min_jaccard
+        self.name = "qgram+" + self.backend.name
+
+    @property
+    def calls(self):
+        return self.backend.calls
+
+    def prepare(self, s):
+        return qgrams(s, self.q), self.backend.prepare(s)
+
+    def matcher(self, prepared2, threshold):
+        grams2, backend_prepared2 = prepared2
+        backend_match = self.backend.matcher(backend_prepared2, threshold)
+        min_jaccard = self.min_jaccard
+
+        def match(prepared1):
+            grams1, backend_prepared1 = prepared1
+            common = len(grams1 & grams2)
+            if common < min_jaccard * (len(grams1) + len(grams2) - common):
+                return False
+            return backend_match(backend_prepared1)
+        return match
+
+    def similarity(self, s1, s2):
+        if jaccard(qgrams(s1, self.q), qgrams(s2, self.q)) < self.min_jaccard:
+            return 0.0
+        return self.backend.similarity(s1, s2)
+
+
+# Backends by name, for get_backend
+BACKENDS = {
+    "difflib": DifflibSimilarity,
+    "levenshtein": LevenshteinSimilarity,
+    "qgram": QGramPrefilter,
+}
+
+
+def get_backend(backend, **kwargs):
+    """
+    :param backend: a SimilarityBackend, or the name of one in BACKENDS
+    :param kwargs: arguments of the backend, when it is given by name
+    :return: the SimilarityBackend
+    """
+    if isinstance(backend, SimilarityBackend):
+        return backend
+    try:
+        return BACKENDS[backend](**kwargs)
+    except KeyError:
+        raise ValueError("Unknown similarity backend " + repr(backend) + ", expected one of " +
+                         ", ".join(sorted(BACKENDS)))
+
+
+def compare_backends(comparisons, backends, threshold=0.9):
+    """
+    Compare the accuracy and the throughput of backends on the same
+    comparisons. The first backend is the reference of the accuracy.
+    :param comparisons: list of (proposition, list of keys it is compared with)
+    :param backends: list of SimilarityBackend
+    :param threshold: the similarity needed to match
+    :return: list of dict, one per backend, with the time, the number of pairs
+    per second, the number of matches, and the false positives and negatives
+    compared with the reference
+    """
+    reference = None
+    results = []
+    for backend in backends:
+        start = time.perf_counter()
+        prepared = {}
+        matches = []
+        for s2, keys in comparisons:
+            if s2 not in prepared:
+                prepared[s2] = backend.prepare(s2)
+            match = backend.matcher(prepared[s2], threshold)
+            for s1 in keys:
+                if s1 not in prepared:
+                    prepared[s1] = backend.prepare(s1)
+                matches.append(match(prepared[s1]))
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference = matches
+        pairs = len(matches)
+        results.append({
+            "backend": backend.name,
+            "seconds": seconds,
+            "pairs_per_second": pairs / seconds if seconds else float("inf"),
+            "pairs": pairs,
+            "matches": sum(matches),
+            "false_positives": sum(m and not r for m, r in zip(matches, reference)),
+            "false_negatives": sum(r and not m for m, r in zip(matches, reference)),
+        })
+    return results
+
+
+def label_comparisons(majorityVoting):
+    """
+    The comparisons of the lossy grouping: each lossy normalized proposition
+    of a label with the other propositions of the label before it.
+    :param majorityVoting: MajorityVoting
+    :return: list of (proposition, list of keys)
+    """
+    comparisons = []
+    for page in majorityVoting.iter_labels_by_page():
+        for label in page["assertions"]:
+            values = []
+            for version in label.versions:
+                value = version["data"].get("value")
+                if value and value not in values:
+                    values.append(value)
+            cleaned = [majorityVoting.lossyClean(majorityVoting._normalize(label, v)) for v in values]
+            for i in range(1, len(cleaned)):
+                comparisons.append((cleaned[i], cleaned[:i]))
+    return comparisons
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the similarity backends on the propositions of a dataset")
+    parser.add_argument("inputFile", help="json file of the pages")
+    parser.add_argument("--threshold", type=float, default=0.9, help="similarity needed to match")
+    parser.add_argument("--min-jaccard", type=float, default=0.5, help="Jaccard similarity of the q-gram prefilter")
+    args = parser.parse_args()
+
+    from Test import MajorityVoting
+    comparisons = label_comparisons(MajorityVoting(args.inputFile, stream=True))
+    backends = [DifflibSimilarity(), LevenshteinSimilarity(),
+                QGramPrefilter(DifflibSimilarity(), min_jaccard=args.min_jaccard),
+                QGramPrefilter(LevenshteinSimilarity(), min_jaccard=args.min_jaccard)]
+    for result in compare_backends(comparisons, backends, args.threshold):
+        print("{backend:<20} {pairs} pairs in {seconds:.3f}s ({pairs_per_second:.0f}/s), {matches} matches, "
+              "{false_positives} false positives, {false_negatives} false negatives".format(**result))
+
+
+if __name__ == "__main__":
+    main()
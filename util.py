@@ -5,11 +5,94 @@ The Australian National University
 2016
 """
 
-import collections
-
 import numpy
+import scipy.sparse
 import scipy.special
 import sklearn.metrics
+import sklearn.utils
+
+
+class SparseLabels(object):
+    """Crowd labels stored as (labeller, sample, label) triples.
+
+    Only the observed labels are stored, so the memory grows with the number
+    of annotations instead of n_labellers * n_samples. The triples are kept
+    sorted by labeller then sample (CSR order).
+    """
+
+    def __init__(self, labellers, samples, labels, shape=None,
+                 presorted=False):
+        """
+        labellers: (n_annotations,) array of labeller indices.
+        samples: (n_annotations,) array of sample indices.
+        labels: (n_annotations,) array of labels.
+        shape: (n_labellers, n_samples). Inferred from the indices if None.
+        presorted: Whether the triples are already in CSR order. They are
+            then used as they are, without a copy.
+        """
+        labellers = numpy.asarray(labellers, dtype=numpy.intp)
+        samples = numpy.asarray(samples, dtype=numpy.intp)
+        labels = numpy.asarray(labels, dtype=float)
+        if not labellers.shape == samples.shape == labels.shape:
+            raise ValueError('labellers, samples and labels have different '
+                             'lengths.')
+
+        if shape is None:
+            shape = (labellers.max() + 1 if labellers.size else 0,
+                     samples.max() + 1 if samples.size else 0)
+
+        if presorted:
+            self.labellers, self.samples, self.labels = \
+                labellers, samples, labels
+        else:
+            order = numpy.lexsort((samples, labellers))
+            self.labellers = labellers[order]
+            self.samples = samples[order]
+            self.labels = labels[order]
+        self.shape = (int(shape[0]), int(shape[1]))
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    @classmethod
+    def from_masked(cls, y):
+        """Converts a (n_labellers, n_samples) masked array of labels."""
+        labellers, samples = numpy.nonzero(~numpy.ma.getmaskarray(y))
+        labels = numpy.ma.getdata(y)[labellers, samples]
+        return cls(labellers, samples, labels, shape=y.shape)
+
+    @classmethod
+    def from_sparse(cls, y):
+        """Converts a (n_labellers, n_samples) SciPy sparse matrix of labels.
+
+        Every stored entry is an observed label, including explicit zeros.
+        """
+        y = y.tocoo()
+        return cls(y.row, y.col, y.data, shape=y.shape)
+
+    def to_masked(self):
+        """-> (n_labellers, n_samples) NumPy masked array of labels."""
+        labels = numpy.zeros(self.shape)
+        mask = numpy.ones(self.shape, dtype=bool)
+        labels[self.labellers, self.samples] = self.labels
+        mask[self.labellers, self.samples] = False
+        return numpy.ma.MaskedArray(labels, mask=mask)
+
+
+def as_sparse_labels(y):
+    """Converts crowd labels to SparseLabels.
+
+    y: SparseLabels, (n_labellers, n_samples) NumPy (masked) array or SciPy
+        sparse matrix, or (labellers, samples, labels) tuple of triples.
+    -> SparseLabels
+    """
+    if isinstance(y, SparseLabels):
+        return y
+    if scipy.sparse.issparse(y):
+        return SparseLabels.from_sparse(y)
+    if isinstance(y, tuple):
+        return SparseLabels(*y)
+    return SparseLabels.from_masked(numpy.ma.asarray(y))
 
 
 def balanced_accuracy(y_true, y_pred):
@@ -35,54 +118,130 @@ def balanced_accuracy(y_true, y_pred):
     return ba
 
 
-def crowd_label(y, alphas, betas):
+def crowd_label(y, alphas=None, betas=None, confusion=None, k=None,
+                sparse=False, random_state=None):
     """Simulates a crowd performing a labelling task.
 
+    All the labels are drawn in one batch from a numpy.random.Generator, so
+    the same random_state gives the same labels.
+
     y: (n_examples,) array of true labels.
-    alphas: (n_labellers,) array of labeller true positive rates.
-    betas: (n_labellers,) array of labeller true negative rates.
+    alphas: (n_labellers,) array of labeller true positive rates (binary
+        labels).
+    betas: (n_labellers,) array of labeller true negative rates (binary
+        labels).
+    confusion: (n_labellers, n_classes, n_classes) array of confusion
+        matrices, confusion[t, c, l] being the probability that labeller t
+        gives the label l to an example of class c. Replaces alphas and betas
+        for multi-class labels.
+    k: Number of examples labelled by each labeller (int or (n_labellers,)
+        array), drawn uniformly without replacement. None for fully observed
+        labels.
+    sparse: Whether to return SparseLabels instead of a masked array.
+    random_state: Seed or numpy.random.Generator.
+    -> (n_labellers, n_examples) NumPy masked array of labels, or
+        SparseLabels.
     """
-    n_labellers = len(alphas)
-    assert n_labellers == len(betas)
+    rng = numpy.random.default_rng(random_state)
+    y = numpy.asarray(y, dtype=numpy.intp)
     n_examples = len(y)
-    labels = numpy.zeros((n_labellers, n_examples))
-    for i, true_label in enumerate(y):
-        for t in range(n_labellers):
-            if true_label == 0:
-                if numpy.random.random() <= betas[t]:
-                    labels[t, i] = 0
-                else:
-                    labels[t, i] = 1
-            else:
-                if numpy.random.random() <= alphas[t]:
-                    labels[t, i] = 1
-                else:
-                    labels[t, i] = 0
-    mask = numpy.zeros(labels.shape)  # Fully observed labels.
-    return numpy.ma.MaskedArray(labels, mask=mask)
-
-
-def majority_vote(y):
+    if confusion is not None:
+        confusion = numpy.asarray(confusion, dtype=float)
+        n_labellers = confusion.shape[0]
+    else:
+        alphas = numpy.asarray(alphas, dtype=float)
+        betas = numpy.asarray(betas, dtype=float)
+        n_labellers = len(alphas)
+        assert n_labellers == len(betas)
+
+    # Observed (labeller, example) pairs, in CSR order.
+    if k is None:
+        labellers = numpy.repeat(numpy.arange(n_labellers), n_examples)
+        samples = numpy.tile(numpy.arange(n_examples), n_labellers)
+    else:
+        k = numpy.broadcast_to(numpy.asarray(k, dtype=numpy.intp),
+                               (n_labellers,))
+        if (k > n_examples).any():
+            raise ValueError('k is larger than the number of examples.')
+        labellers = numpy.repeat(numpy.arange(n_labellers), k)
+        samples = numpy.concatenate(
+            [numpy.sort(rng.choice(n_examples, size=k_t, replace=False,
+                                   shuffle=False))
+             for k_t in k]) if n_labellers else numpy.zeros(0, numpy.intp)
+
+    true_labels = y[samples]
+    u = rng.random(len(samples))
+    if confusion is not None:
+        # Inverse transform sampling of the row of the confusion matrix.
+        cumulative = numpy.cumsum(confusion, axis=2)[labellers, true_labels]
+        labels = (u[:, None] > cumulative).sum(axis=1)
+        numpy.minimum(labels, confusion.shape[2] - 1, out=labels)
+    else:
+        correct = numpy.where(true_labels == 0, betas[labellers],
+                              alphas[labellers])
+        labels = numpy.where(u <= correct, true_labels, 1 - true_labels)
+
+    sparse_labels = SparseLabels(labellers, samples, labels,
+                                 shape=(n_labellers, n_examples),
+                                 presorted=True)
+    if sparse:
+        return sparse_labels
+    return sparse_labels.to_masked()
+
+
+def majority_vote(y, random_state=None, tie_break='first'):
     """Computes the majority vote of a set of crowd labels.
 
-    y: (n_annotators, n_examples) NumPy masked array of labels.
+    The votes are counted with one bincount over (example, label) pairs, for
+    any number of classes.
+
+    y: (n_annotators, n_examples) NumPy masked array of labels, or
+        SparseLabels.
+    random_state: Seed or numpy.random.RandomState used to label the
+        examples that have no labels, and to break the ties with
+        tie_break='random'. None uses the global random state.
+    tie_break: 'first' gives a tie to the label of the first annotator who
+        gave one of the tied labels, 'random' to one of the tied labels drawn
+        from random_state.
     -> (n_examples,) NumPy array of labels.
     """
+    random_state = sklearn.utils.check_random_state(random_state)
+    if tie_break not in ('first', 'random'):
+        raise ValueError('tie_break must be "first" or "random".')
+    y = as_sparse_labels(y)
     _, n_samples = y.shape
-    mv = numpy.zeros((n_samples,))
-    for i in range(n_samples):
-        labels = y[:, i]
 
-        if labels.mask is False:
-            counter = collections.Counter(labels)
+    classes, codes = numpy.unique(y.labels, return_inverse=True)
+    n_classes = len(classes)
+    pairs = y.samples * n_classes + codes
+    counts = numpy.bincount(pairs, minlength=n_samples * n_classes).reshape(
+        (n_samples, n_classes)).astype(float)
+    labelled = counts.any(axis=1) if n_classes else numpy.zeros(n_samples,
+                                                                bool)
+
+    if n_classes:
+        if tie_break == 'first':
+            # The triples are sorted by annotator, so the first occurrence of
+            # a pair is the one of the first annotator. Among the labels with
+            # the most votes, the one seen first wins.
+            first = numpy.full(n_samples * n_classes, len(y), dtype=float)
+            seen, index = numpy.unique(pairs, return_index=True)
+            first[seen] = index
+            counts -= first.reshape((n_samples, n_classes)) / (len(y) + 1)
         else:
-            counter = collections.Counter(labels[~labels.mask])
+            # Integer counts, so a jitter in [0, 1) only breaks the ties.
+            counts += random_state.random_sample(counts.shape)
+        mv = classes[counts.argmax(axis=1)].astype(float)
+    else:
+        mv = numpy.zeros((n_samples,))
 
-        if counter:
-            mv[i] = max(counter, key=counter.get)
-        else:
-            # No labels for this data point.
-            mv[i] = numpy.random.randint(2)  # ¯\_(ツ)_/¯
+    # No labels for these data points.
+    unlabelled = ~labelled
+    if n_classes > 2:
+        mv[unlabelled] = classes[random_state.randint(
+            n_classes, size=unlabelled.sum())]
+    else:
+        mv[unlabelled] = random_state.randint(2, size=unlabelled.sum())
     return mv
 
 